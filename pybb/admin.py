@@ -2,10 +2,11 @@
 
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.gis import admin
+from django.contrib.admin.actions import delete_selected
 from django.core.urlresolvers import reverse
 from django.conf import settings
 
-from pybb.models import Category, Forum, Topic, Post, Profile, Attachment, PollAnswer, WatchArea
+from pybb.models import Category, Forum, Topic, Post, Profile, Attachment, PollAnswer, WatchArea, recount_counters
 
 
 class ForumInlineAdmin(admin.TabularInline):
@@ -53,7 +54,34 @@ class PollAnswerAdmin(admin.TabularInline):
     extra = 0
 
 
-class TopicAdmin(admin.ModelAdmin):
+def delete_selected_and_recount(modeladmin, request, queryset):
+    """
+    Default delete action, which also recounts counters of topics and forums of deleted objects
+    """
+    if queryset.model is Post:
+        topic_ids = set(queryset.values_list('topic_id', flat=True))
+        forum_ids = set(queryset.values_list('topic__forum_id', flat=True))
+    else:
+        topic_ids = ()
+        forum_ids = set(queryset.values_list('forum_id', flat=True))
+    response = delete_selected(modeladmin, request, queryset)
+    if response is None:
+        # Objects are deleted, otherwise confirmation page is returned
+        recount_counters(topic_ids, forum_ids)
+    return response
+delete_selected_and_recount.short_description = delete_selected.short_description
+
+
+class RecountDeleteMixin(object):
+    actions = [delete_selected_and_recount]
+
+    def get_actions(self, request):
+        actions = super(RecountDeleteMixin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+
+class TopicAdmin(RecountDeleteMixin, admin.ModelAdmin):
     list_display = ['name', 'forum', 'created', 'head', 'post_count', 'poll_type',]
     list_per_page = 20
     raw_id_fields = ['user', 'subscribers']
@@ -81,7 +109,7 @@ class ForumReadTrackerAdmin(admin.ModelAdmin):
     list_display = ['forum', 'user', 'time_stamp']
     search_fields = ['user__username']
 
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(RecountDeleteMixin, admin.ModelAdmin):
     list_display = ['topic', 'user', 'created', 'updated', 'summary']
     list_per_page = 20
     raw_id_fields = ['user', 'topic']
@@ -117,7 +145,7 @@ class ProfileAdmin(admin.ModelAdmin):
          ),
         (_('Additional options'), {
                 'classes': ('collapse',),
-                'fields' : ('avatar', 'signature', 'show_signatures')
+                'fields' : ('avatar', 'signature', 'show_signatures', 'digest')
                 }
          ),
         )
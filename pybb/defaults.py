@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os.path
+import re
 
 from django.conf import settings
 
@@ -50,11 +51,15 @@ PYBB_SMILES = getattr(settings, 'PYBB_SMILES', {
     ';)': 'wink.png'
 })
 
+_SMILE_IMAGES = dict((smile, '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL, PYBB_SMILES_PREFIX, url))
+                     for smile, url in PYBB_SMILES.items())
+# Longer smiles go first, so smile containing another one is matched as a whole
+_SMILE_RE = re.compile('|'.join(re.escape(smile) for smile in sorted(PYBB_SMILES, key=len, reverse=True)))
+
 def smile_it(str):
-    s = str
-    for smile, url in PYBB_SMILES.items():
-        s = s.replace(smile, '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL, PYBB_SMILES_PREFIX, url))
-    return s
+    if not PYBB_SMILES:
+        return str
+    return _SMILE_RE.sub(lambda match: _SMILE_IMAGES[match.group(0)], str)
 
 PYBB_MARKUP_ENGINES = getattr(settings, 'PYBB_MARKUP_ENGINES', {
     'bbcode': lambda str: urlize(smile_it(render_bbcode(str, exclude_tags=['size', 'center']))),
@@ -67,6 +72,8 @@ PYBB_QUOTE_ENGINES = getattr(settings, 'PYBB_QUOTE_ENGINES', {
 })
 
 PYBB_MARKUP = getattr(settings, 'PYBB_MARKUP', 'bbcode')
+PYBB_RENDER_CACHE = getattr(settings, 'PYBB_RENDER_CACHE', None)
+PYBB_RENDER_CACHE_VERSION = getattr(settings, 'PYBB_RENDER_CACHE_VERSION', 1)
 PYBB_BUTTONS = getattr(settings, 'PYBB_BUTTONS', {})
 #Dict of buttons that will be used, instead of text links if defined
 #Currently supported buttons:
@@ -88,4 +95,26 @@ PYBB_POLL_MAX_ANSWERS = getattr(settings, 'PYBB_POLL_MAX_ANSWERS', 10)
 
 PYBB_AUTO_USER_PERMISSIONS = getattr(settings, 'PYBB_AUTO_USER_PERMISSIONS', True)
 
-PYBB_USE_DJANGO_MAILER = getattr(settings, 'PYBB_USE_DJANGO_MAILER', False)
\ No newline at end of file
+PYBB_USE_DJANGO_MAILER = getattr(settings, 'PYBB_USE_DJANGO_MAILER', False)
+PYBB_NOTIFICATION_QUEUE = getattr(settings, 'PYBB_NOTIFICATION_QUEUE', False)
+
+PYBB_DELTA_COUNTERS = getattr(settings, 'PYBB_DELTA_COUNTERS', True)
+
+PYBB_PERMISSION_CACHE = getattr(settings, 'PYBB_PERMISSION_CACHE', None)
+
+PYBB_READ_TRACKING_BACKEND = getattr(settings, 'PYBB_READ_TRACKING_BACKEND', 'pybb.read_tracking.TrackerReadTracking')
+
+PYBB_VIEWS_BUFFER = getattr(settings, 'PYBB_VIEWS_BUFFER', None)
+PYBB_VIEWS_BUFFER_CACHE = getattr(settings, 'PYBB_VIEWS_BUFFER_CACHE', 'default')
+PYBB_VIEWS_FLUSH_INTERVAL = getattr(settings, 'PYBB_VIEWS_FLUSH_INTERVAL', 60)
+
+PYBB_KEYSET_PAGINATION = getattr(settings, 'PYBB_KEYSET_PAGINATION', False)
+PYBB_PAGINATION_COUNT_CACHE = getattr(settings, 'PYBB_PAGINATION_COUNT_CACHE', None)
+PYBB_PAGINATION_COUNT_TIMEOUT = getattr(settings, 'PYBB_PAGINATION_COUNT_TIMEOUT', 60)
+
+PYBB_FRAGMENT_CACHE = getattr(settings, 'PYBB_FRAGMENT_CACHE', None)
+PYBB_FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'PYBB_FRAGMENT_CACHE_TIMEOUT', 60)
+
+PYBB_PAGE_CACHE = getattr(settings, 'PYBB_PAGE_CACHE', None)
+PYBB_PAGE_CACHE_TIMEOUT = getattr(settings, 'PYBB_PAGE_CACHE_TIMEOUT', 60)
+PYBB_PURGE_BACKEND = getattr(settings, 'PYBB_PURGE_BACKEND', None)
@@ -38,4 +38,5 @@ class LastTopics(PybbFeed):
     description_template = 'pybb/feeds/topics_description.html'
 
     def items(self):
-        return Topic.objects.filter(forum__hidden=False, forum__category__hidden=False).order_by('-created')[:15]
+        return Topic.objects.filter(forum__hidden=False, forum__category__hidden=False)\
+            .select_related('forum', 'head_post', 'head_post__user').order_by('-created')[:15]
@@ -148,6 +148,7 @@ class PostForm(forms.ModelForm):
             if self.user:
                 post.user = self.user
             if post.topic.head == post:
+                post.topic.refresh_counters()
                 post.topic.name = self.cleaned_data['name']
                 post.topic.place = self.cleaned_data['place']
                 post.topic.poll_type = self.cleaned_data['poll_type']
@@ -214,7 +215,7 @@ class EditProfileForm(forms.ModelForm):
     class Meta(object):
         model = profile_model
         fields = ['signature', 'time_zone', 'language',
-                  'show_signatures', 'avatar']
+                  'show_signatures', 'avatar', 'digest']
 
     signature = forms.CharField(widget=forms.Textarea(attrs={'rows': 2, 'cols:': 60}), required=False)
 
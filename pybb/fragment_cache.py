@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""
+Template fragment cache with versioned keys. Every object has version counter in
+PYBB_FRAGMENT_CACHE, counters are incremented by signals when objects are changed, so
+fragments rendered for previous versions are never used again and expire by timeout.
+"""
+
+from hashlib import sha1
+import time
+
+from django.utils import translation
+
+from pybb import defaults
+
+VERSION_KEY = 'pybb_version:%s.%s:%s'
+FRAGMENT_KEY = 'pybb_fragment:%s:%s:%s'
+
+
+def get_fragment_cache():
+    """
+    Return cache configured with PYBB_FRAGMENT_CACHE or None if fragment caching is disabled
+    """
+    if not defaults.PYBB_FRAGMENT_CACHE:
+        return None
+    from django.core.cache import get_cache
+    return get_cache(defaults.PYBB_FRAGMENT_CACHE)
+
+
+def version_key(model, pk):
+    return VERSION_KEY % (model._meta.app_label, model._meta.object_name.lower(), pk)
+
+
+def get_versions(cache, keys):
+    """
+    Return versions for list of version keys. Missing counters are started from current
+    time, so counter evicted from cache does not return to one of its previous values.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            initial = int(time.time() * 1000)
+            if not cache.add(key, initial):
+                initial = cache.get(key, initial)
+            versions[key] = initial
+    return [versions[key] for key in keys]
+
+
+def bump_versions(*objects):
+    """
+    Increment version counters of (model, pk) pairs
+    """
+    cache = get_fragment_cache()
+    if cache is None:
+        return
+    for model, pk in objects:
+        if pk is None:
+            continue
+        try:
+            cache.incr(version_key(model, pk))
+        except ValueError:
+            # Counter is not started yet, or evicted
+            pass
+
+
+def fragment_key(cache, name, objects):
+    """
+    Return key of fragment `name` rendered for given objects in current language
+    """
+    keys = [version_key(obj.__class__, obj.pk) for obj in objects if obj is not None]
+    versions = get_versions(cache, keys)
+    state = '|'.join('%s=%s' % pair for pair in zip(keys, versions))
+    return FRAGMENT_KEY % (name, translation.get_language(), sha1(state).hexdigest())
@@ -10,7 +10,7 @@ except:
 from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Count
 
-from pybb.models import Topic
+from pybb.models import Topic, recount_counters
 
 class Command(BaseCommand):
     help = 'Resave all posts.'
@@ -27,7 +27,9 @@ class Command(BaseCommand):
             answer = raw_input('Are you sure you want delete them? [y/n]:')
             if answer.lower() == 'y':
                 print 'Deleting topics'
+                forum_ids = set(topics.values_list('forum_id', flat=True))
                 topics.delete()
+                recount_counters(forum_ids=forum_ids)
                 print 'Deletion completed'
             else:
                 print 'Aborting'
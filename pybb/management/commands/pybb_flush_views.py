@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from django.core.management.base import BaseCommand
+
+from pybb.view_counter import flush_cache
+
+class Command(BaseCommand):
+    help = 'Write topic views buffered in cache to database'
+
+    def handle(self, *args, **options):
+        flushed = flush_cache()
+        self.stdout.write('Updated views of %d topics\n' % flushed)
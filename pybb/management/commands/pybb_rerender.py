@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils.html import strip_tags
+
+from pybb import page_cache
+from pybb.fragment_cache import bump_versions
+from pybb.models import Post
+from pybb.util import render_markup, unescape, get_profile_model
+
+
+def render_item(item):
+    """
+    Render (pk, text) pair with current markup engine, return (pk, html, plain text)
+    Html in render cache could be rendered by the previous engine, so it is refreshed, not read.
+    """
+    pk, text = item
+    html = render_markup(text, refresh=True)
+    return pk, html, unescape(strip_tags(html))
+
+
+class Command(BaseCommand):
+    args = '[posts] [signatures]'
+    help = 'Render again html of post bodies and profile signatures without saving objects'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+                    help='Number of objects loaded, rendered and written at a time'),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of processes used for rendering'),
+        make_option('--start-id', dest='start_id', type='int', default=0,
+                    help='Start from object with this id, to resume interrupted run of single target'),
+    )
+
+    def handle(self, *args, **options):
+        targets = args or ('posts', 'signatures')
+        for target in targets:
+            if target not in ('posts', 'signatures'):
+                raise CommandError('Usage: pybb_rerender %s' % self.args)
+        if options['start_id'] and len(targets) > 1:
+            # Ids of posts and profiles are not related
+            raise CommandError('--start-id can be used with a single target only')
+
+        pool = None
+        if options['processes'] > 1:
+            # Worker processes only render, they should not share database connection
+            connection.close()
+            pool = Pool(options['processes'])
+        try:
+            if 'posts' in targets:
+                self.rerender(Post, 'body', 'body_html', 'body_text', pool, **options)
+            if 'signatures' in targets:
+                self.rerender(get_profile_model(), 'signature', 'signature_html', None, pool, **options)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def rerender(self, model, field, html_field, text_field, pool, chunk_size, start_id, **options):
+        """
+        Walk through objects ordered by id in chunks and update rendered fields with plain UPDATE queries,
+        so no signals are sent and counters are not touched. Caches are invalidated explicitly for every chunk.
+        """
+        render = pool.map if pool is not None else map
+        queryset = model.objects.filter(pk__gte=start_id).order_by('pk')
+        total = queryset.count()
+        done = 0
+        last_pk = None
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            items = list(chunk.values_list('pk', field)[:chunk_size])
+            if not items:
+                break
+            self.update(model, html_field, text_field, render(render_item, items))
+            self.invalidate(model, [pk for pk, text in items])
+            last_pk = items[-1][0]
+            done += len(items)
+            self.stdout.write('Rendered %d of %d %s, last id %d\n' % (done, total, model._meta.verbose_name_plural, last_pk))
+
+    @transaction.commit_on_success
+    def update(self, model, html_field, text_field, rendered):
+        for pk, html, text in rendered:
+            values = {html_field: html}
+            if text_field:
+                values[text_field] = text
+            model.objects.filter(pk=pk).update(**values)
+
+    def invalidate(self, model, pks):
+        """
+        Bump fragment versions of rendered objects and purge pages of topics which display them
+        """
+        bump_versions(*[(model, pk) for pk in pks])
+        if not page_cache.is_enabled():
+            return
+        if model is Post:
+            posts = Post.objects.filter(pk__in=pks)
+        else:
+            # Signatures are shown with every post of their users
+            posts = Post.objects.filter(user__in=model.objects.filter(pk__in=pks).values('user'))
+        topic_ids = posts.order_by().values_list('topic_id', flat=True).distinct()
+        page_cache.purge(*[page_cache.TOPIC_KEY % topic_id for topic_id in topic_ids])
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pybb.models import DIGEST_HOURLY, DIGEST_DAILY
+from pybb.subscription import send_digests
+
+class Command(BaseCommand):
+    args = '<hourly|daily>'
+    help = 'Send digest emails to users with given digest period'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+                    help='Number of users processed at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in (DIGEST_HOURLY, DIGEST_DAILY):
+            raise CommandError('Usage: pybb_send_digests %s' % self.args)
+        sent = send_digests(args[0], batch_size=options['batch_size'])
+        self.stdout.write('Sent %d digests\n' % sent)
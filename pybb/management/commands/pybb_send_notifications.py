@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from pybb.subscription import send_queued_notifications
+
+class Command(BaseCommand):
+    help = 'Send queued notifications to topic subscribers'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+                    help='Number of queued posts processed at a time'),
+    )
+
+    def handle(self, *args, **options):
+        processed = send_queued_notifications(batch_size=options['batch_size'])
+        self.stdout.write('Processed %d queued notifications\n' % processed)
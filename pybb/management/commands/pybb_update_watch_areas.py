@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pybb.models import WatchArea
+
+class Command(BaseCommand):
+    help = 'Rebuild topic membership for all watch areas'
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+
+        for watch_area in WatchArea.objects.all():
+            watch_area.update_topics()
+            self.stdout.write('Successfully updated watch area "%s"\n' % watch_area)
@@ -3,30 +3,56 @@
 from django.utils import translation
 from django.db.models import ObjectDoesNotExist
 
+from pybb import defaults
 from pybb.signals import user_saved
+from pybb.util import update_fields
+
+
+PROFILE_LANGUAGE_KEY = 'pybb_profile_language'
 
 
 class PybbMiddleware(object):
+    """
+    Activate language of user profile. Profile language is remembered in session,
+    so profile is loaded only on first request of session, or when view or template
+    calls user.get_profile().
+    """
+
     def process_request(self, request):
         if request.user.is_authenticated():
-            try:
-                # Here we try to load profile, but can get error
-                # if user created during syncdb but profile model
-                # under south control. (Like pybb.Profile).
-                profile = request.user.get_profile()
-            except ObjectDoesNotExist:
-                # Ok, we should create new profile for this user
-                # and grant permissions for add posts
-                user_saved(request.user, created=True)
-                profile = request.user.get_profile()
-
             language = translation.get_language_from_request(request)
+            profile_language = request.session.get(PROFILE_LANGUAGE_KEY)
+            if profile_language is None:
+                profile_language = self.sync_profile_language(request.user, language)
+                request.session[PROFILE_LANGUAGE_KEY] = profile_language
 
-            if not profile.language:
-                profile.language = language
-                profile.save()
-
-            if profile.language and profile.language != language:
-                request.session['django_language'] = profile.language
-                translation.activate(profile.language)
+            if profile_language and profile_language != language:
+                request.session['django_language'] = profile_language
+                translation.activate(profile_language)
                 request.LANGUAGE_CODE = translation.get_language()
+
+    def sync_profile_language(self, user, language):
+        """
+        Return language of user profile, store current language in profile if it's not set
+        """
+        try:
+            # Here we try to load profile, but can get error
+            # if user created during syncdb but profile model
+            # under south control. (Like pybb.Profile).
+            profile = user.get_profile()
+        except ObjectDoesNotExist:
+            # Ok, we should create new profile for this user
+            # and grant permissions for add posts
+            user_saved(user, created=True)
+            profile = user.get_profile()
+
+        if not profile.language:
+            profile.language = language
+            update_fields(profile, 'language')
+        return profile.language
+
+    def process_response(self, request, response):
+        if defaults.PYBB_VIEWS_BUFFER == 'memory':
+            from pybb.view_counter import flush_memory_if_needed
+            flush_memory_if_needed()
+        return response
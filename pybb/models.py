@@ -13,7 +13,7 @@ from django.conf import settings
 
 from annoying.fields import AutoOneToOneField
 from sorl.thumbnail import ImageField
-from pybb.util import unescape
+from pybb.util import unescape, render_markup, to_microseconds, from_microseconds, update_fields
 
 try:
     from hashlib import sha1
@@ -47,6 +47,16 @@ TZ_CHOICES = [(float(x[0]), x[1]) for x in (
 (11.5, '+11.5'), (12, '+12'), (13, '+13'), (14, '+14'),
 )]
 
+DIGEST_IMMEDIATE = 'immediate'
+DIGEST_HOURLY = 'hourly'
+DIGEST_DAILY = 'daily'
+
+DIGEST_CHOICES = (
+    (DIGEST_IMMEDIATE, _('Immediately')),
+    (DIGEST_HOURLY, _('Hourly digest')),
+    (DIGEST_DAILY, _('Daily digest')),
+)
+
 #noinspection PyUnusedLocal
 def get_file_path(instance, filename, to='pybb/avatar'):
     """
@@ -72,6 +82,28 @@ def default_forum():
             raise ImproperlyConfigured('Forum %s (PYBB_FORUM_ID) does not exist.' % forum_id)
     return None
 
+def recount_counters(topic_ids=(), forum_ids=()):
+    """
+    Recount counters of topics and forums with update_counters. Queryset delete does not call
+    delete() of models, so counters shifted there should be recounted after it.
+    """
+    for topic in Topic.objects.filter(pk__in=topic_ids):
+        if topic.posts.exists():
+            topic.update_counters()
+    for forum in Forum.objects.filter(pk__in=forum_ids):
+        forum.update_counters()
+
+def last_post_fields(posts):
+    """
+    Return ``last_post`` and ``updated`` values for the most recent post in
+    ``posts``, suitable for passing to ``add_counters``.
+    """
+    try:
+        last_post = posts.order_by('-created')[0]
+    except IndexError:
+        return {'last_post': None}
+    return {'last_post': last_post, 'updated': last_post.updated or last_post.created}
+
 class Category(models.Model):
     name = models.CharField(_('Name'), max_length=80)
     position = models.IntegerField(_('Position'), blank=True, default=0)
@@ -114,6 +146,8 @@ class Forum(models.Model):
     hidden = models.BooleanField(_('Hidden'), blank=False, null=False, default=False)
     readed_by = models.ManyToManyField(User, through='ForumReadTracker', related_name='readed_forums')
     headline = models.TextField(_('Headline'), blank=True, null=True)
+    last_post = models.ForeignKey('Post', related_name='+', verbose_name=_('Last post'),
+        blank=True, null=True, on_delete=models.SET_NULL)
 
     class Meta(object):
         ordering = ['position']
@@ -130,10 +164,25 @@ class Forum(models.Model):
         try:
             last_post = posts.order_by('-created')[0]
             self.updated = last_post.updated or last_post.created
+            self.last_post = last_post
         except IndexError:
-            pass
+            self.last_post = None
 
-        self.save()
+        update_fields(self, 'post_count', 'topic_count', 'updated', 'last_post')
+
+    def add_counters(self, topics=0, posts=0, **fields):
+        """
+        Shift the topic and post counters by the given deltas and set any other
+        ``fields`` with a single UPDATE, instead of recounting with update_counters.
+        """
+        self.topic_count += topics
+        self.post_count += posts
+        for name, value in fields.items():
+            setattr(self, name, value)
+        Forum.objects.filter(pk=self.pk).update(
+            topic_count=models.F('topic_count') + topics,
+            post_count=models.F('post_count') + posts,
+            **fields)
 
     def get_absolute_url(self):
         return reverse('pybb:forum', kwargs={'pk': self.id})
@@ -143,14 +192,7 @@ class Forum(models.Model):
         return Post.objects.filter(topic__forum=self).select_related()
 
     def get_last_post(self):
-        try:
-            return self.posts.order_by('-created')[0]
-        except IndexError:
-            return None
-
-    @property
-    def last_post(self):
-        return self.get_last_post()
+        return self.last_post
 
     def get_parents(self):
         """
@@ -179,6 +221,30 @@ class WatchAreaManager(models.GeoManager):
 
         return watch_areas
 
+    def with_topic_stats(self, watch_areas):
+        """
+        Annotate the watch areas with ``topic_count`` and ``latest_update``
+        for their member topics. Stats come from one grouped query over the
+        WatchAreaTopic membership table, separate from the watch areas query,
+        so they are not multiplied by other joins like watchers.
+        """
+        watch_areas = list(watch_areas)
+        stats = WatchAreaTopic.objects\
+            .filter(watch_area__in=[watch_area.pk for watch_area in watch_areas])\
+            .values('watch_area')\
+            .annotate(topic_count=models.Count('topic'),
+                      latest_topic_updated=models.Max('topic__updated'),
+                      latest_topic_created=models.Max('topic__created'))
+        stats = dict((row['watch_area'], row) for row in stats)
+        for watch_area in watch_areas:
+            row = stats.get(watch_area.pk, {})
+            watch_area.topic_count = row.get('topic_count', 0)
+            dates = [date for date in (row.get('latest_topic_updated'),
+                                       row.get('latest_topic_created'))
+                     if date is not None]
+            watch_area.latest_update = max(dates) if dates else None
+        return watch_areas
+
 
 class WatchArea(models.Model):
     name = models.CharField(_('Name'), max_length=80)
@@ -190,6 +256,8 @@ class WatchArea(models.Model):
     watchers = models.ManyToManyField(User, related_name='areas',
         verbose_name=_('Watchers'), blank=True)
     public = models.BooleanField(_('Public'), default=False)
+    topics = models.ManyToManyField('Topic', through='WatchAreaTopic', related_name='watch_areas',
+        verbose_name=_('Topics'), blank=True)
 
     objects = WatchAreaManager()
 
@@ -209,6 +277,15 @@ class WatchArea(models.Model):
             self.created = tznow()
         super(WatchArea, self).save(*args, **kwargs)
 
+    def update_topics(self):
+        """
+        Rebuild the topic membership of this watch area from its fence
+        """
+        WatchAreaTopic.objects.filter(watch_area=self).delete()
+        topic_ids = Topic.objects.filter(place__intersects=self.fence).values_list('id', flat=True)
+        WatchAreaTopic.objects.bulk_create([
+            WatchAreaTopic(watch_area=self, topic_id=topic_id) for topic_id in topic_ids])
+
     def forum(self):
         if not hasattr(self, '_forum'):
             self._forum = default_forum()
@@ -251,6 +328,10 @@ class Topic(models.Model):
     on_moderation = models.BooleanField(_('On moderation'), default=False)
     poll_type = models.IntegerField(_('Poll type'), choices=POLL_TYPE_CHOICES, default=POLL_TYPE_NONE)
     poll_question = models.TextField(_('Poll question'), blank=True, null=True)
+    head_post = models.ForeignKey('Post', related_name='+', verbose_name=_('Head post'),
+        blank=True, null=True, on_delete=models.SET_NULL)
+    last_post = models.ForeignKey('Post', related_name='+', verbose_name=_('Last post'),
+        blank=True, null=True, on_delete=models.SET_NULL)
     objects = models.GeoManager()
 
     class Meta(object):
@@ -264,34 +345,74 @@ class Topic(models.Model):
     @property
     def head(self):
         """
-        Get first post and cache it for request
+        Get first post of the topic
         """
-        if not hasattr(self, "_head"):
-            self._head = self.posts.all().order_by('created')
-        if not len(self._head):
-            return None
-        return self._head[0]
+        return self.head_post
 
     def get_last_post(self):
-        return self.posts.order_by('-created').select_related()[0]
-
-    @property
-    def last_post(self):
-        return self.get_last_post()
+        return self.last_post
 
     def get_absolute_url(self):
         return reverse('pybb:topic', kwargs={'pk': self.id})
 
     def save(self, *args, **kwargs):
-        if self.id is None:
+        new = self.id is None
+        if new:
             self.created = tznow()
         super(Topic, self).save(*args, **kwargs)
+        if new and defaults.PYBB_DELTA_COUNTERS:
+            self.forum.add_counters(topics=1)
+
+    def delete(self, *args, **kwargs):
+        forum = self.forum
+        # Counter could be shifted after this instance was loaded
+        post_count = Topic.objects.filter(pk=self.pk).values_list('post_count', flat=True).get()
+        super(Topic, self).delete(*args, **kwargs)
+        if defaults.PYBB_DELTA_COUNTERS:
+            fields = {}
+            if forum.last_post_id is None or forum.last_post_id == self.last_post_id:
+                fields = last_post_fields(Post.objects.filter(topic__forum=forum))
+            forum.add_counters(topics=-1, posts=-post_count, **fields)
+
+    def update_watch_areas(self):
+        """
+        Rebuild the watch area membership of this topic from its place
+        """
+        WatchAreaTopic.objects.filter(topic=self).delete()
+        watch_area_ids = WatchArea.objects.filter(fence__intersects=self.place).values_list('id', flat=True)
+        WatchAreaTopic.objects.bulk_create([
+            WatchAreaTopic(watch_area_id=watch_area_id, topic=self) for watch_area_id in watch_area_ids])
 
     def update_counters(self):
         self.post_count = self.posts.count()
         last_post = Post.objects.filter(topic_id=self.id).order_by('-created')[0]
         self.updated = last_post.updated or last_post.created
-        self.save()
+        self.last_post = last_post
+        self.head_post = Post.objects.filter(topic_id=self.id).order_by('created')[0]
+        update_fields(self, 'post_count', 'updated', 'last_post', 'head_post')
+
+    def refresh_counters(self):
+        """
+        Reload counter fields, which could be shifted with add_counters after topic was loaded,
+        so full save does not write stale values over them.
+        """
+        self.post_count, self.updated, self.last_post_id, self.head_post_id = Topic.objects.filter(pk=self.pk)\
+            .values_list('post_count', 'updated', 'last_post', 'head_post')[0]
+        # Drop related objects cached for previous ids
+        self.__dict__.pop('_last_post_cache', None)
+        self.__dict__.pop('_head_post_cache', None)
+
+    def add_counters(self, posts=0, **fields):
+        """
+        Shift the post counter by ``posts`` and set any other ``fields`` with
+        a single UPDATE, instead of recounting with update_counters.
+        """
+        self.post_count += posts
+        for name, value in fields.items():
+            setattr(self, name, value)
+        Topic.objects.filter(pk=self.pk).update(
+            post_count=models.F('post_count') + posts,
+            **fields)
 
     def get_parents(self):
         """
@@ -309,6 +430,20 @@ class Topic(models.Model):
             return None
 
 
+class WatchAreaTopic(models.Model):
+    """
+    Materialized membership of topics in watch areas, so that listing and
+    counting the topics of a watch area does not need a spatial lookup
+    """
+    class Meta(object):
+        verbose_name = _('Watch area topic')
+        verbose_name_plural = _('Watch area topics')
+        unique_together = (('watch_area', 'topic'), )
+
+    watch_area = models.ForeignKey(WatchArea, verbose_name=_('Watch Area'))
+    topic = models.ForeignKey(Topic, verbose_name=_('Topic'))
+
+
 class RenderableItem(models.Model):
     """
     Base class for models that has markup, body, body_text and body_html fields.
@@ -322,7 +457,7 @@ class RenderableItem(models.Model):
     body_text = models.TextField(_('Text version'))
 
     def render(self):
-        self.body_html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](self.body)
+        self.body_html = render_markup(self.body)
         # Remove tags which was generated with the markup processor
         text = strip_tags(self.body_html)
         # Unescape entities which was generated with the markup processor
@@ -338,6 +473,7 @@ class Post(RenderableItem):
     on_moderation = models.BooleanField(_('On moderation'), default=False)
 
     class Meta(object):
+        # Index on (topic, created) is created by migration
         ordering = ['created']
         verbose_name = _('Post')
         verbose_name_plural = _('Posts')
@@ -359,29 +495,75 @@ class Post(RenderableItem):
 
         update_counters = kwargs.pop('update_counters', True)
 
+        moved_from = None
+        if not new and update_counters and defaults.PYBB_DELTA_COUNTERS \
+                and not getattr(self, '_counters_pending', False):
+            moved_from = Post.objects.filter(pk=self.pk).values_list('topic_id', 'topic__forum_id').get()
+            if moved_from[0] == self.topic_id:
+                moved_from = None
+
         super(Post, self).save(*args, **kwargs)
 
+        if new and self.topic.head_post_id is None:
+            Topic.objects.filter(pk=self.topic_id, head_post__isnull=True).update(head_post=self)
+            self.topic.head_post = self
+
         # If post is topic head and moderated, moderate topic too
         if self.topic.head == self and self.on_moderation == False and self.topic.on_moderation == True:
             self.topic.on_moderation = False
+            update_fields(self.topic, 'on_moderation')
         if update_counters:
-            self.topic.update_counters()
-            self.topic.forum.update_counters()
+            if not defaults.PYBB_DELTA_COUNTERS:
+                self.topic.update_counters()
+                self.topic.forum.update_counters()
+            elif new or getattr(self, '_counters_pending', False):
+                self._counters_pending = False
+                updated = self.updated or self.created
+                self.topic.add_counters(posts=1, updated=updated, last_post=self)
+                self.topic.forum.add_counters(posts=1, updated=updated, last_post=self)
+            elif moved_from is not None:
+                # Post moved to another topic, head and last posts of both topics can change
+                recount_counters(topic_ids=(moved_from[0], self.topic_id),
+                                 forum_ids=(moved_from[1], self.topic.forum_id))
+                self.topic.refresh_counters()
+            else:
+                # Edited last post sets update time of topic and forum, as update_counters does
+                updated = self.updated or self.created
+                if self.topic.last_post_id == self.pk:
+                    self.topic.add_counters(updated=updated)
+                if self.topic.forum.last_post_id == self.pk:
+                    self.topic.forum.add_counters(updated=updated)
+        elif new:
+            # Counters will be shifted by the first save with update_counters
+            self._counters_pending = True
 
     def get_absolute_url(self):
         return reverse('pybb:post', kwargs={'pk': self.id})
 
     def delete(self, *args, **kwargs):
         self_id = self.id
-        head_post_id = self.topic.posts.order_by('created')[0].id
+        head_post_id = self.topic.head_post_id
 
         if self_id == head_post_id:
             self.topic.delete()
-        else:
+        elif not defaults.PYBB_DELTA_COUNTERS:
             super(Post, self).delete(*args, **kwargs)
             self.topic.update_counters()
-
-        self.topic.forum.update_counters()
+        else:
+            super(Post, self).delete(*args, **kwargs)
+            if not getattr(self, '_counters_pending', False):
+                topic, forum = self.topic, self.topic.forum
+                topic_fields, forum_fields = {}, {}
+                # Only look for the new last post when the deleted one was the last
+                if topic.last_post_id == self_id:
+                    topic_fields = last_post_fields(topic.posts.all())
+                if forum.last_post_id == self_id:
+                    forum_fields = last_post_fields(Post.objects.filter(topic__forum=forum))
+                topic.add_counters(posts=-1, **topic_fields)
+                forum.add_counters(posts=-1, **forum_fields)
+
+        if not defaults.PYBB_DELTA_COUNTERS:
+            self.topic.forum.update_counters()
 
     def get_parents(self):
         """
@@ -421,9 +603,12 @@ class PybbProfile(models.Model):
     autosubscribe = models.BooleanField(_('Automatically subscribe'),
         help_text=_('Automatically subscribe to topics that you answer'),
         default=defaults.PYBB_DEFAULT_AUTOSUBSCRIBE)
+    digest = models.CharField(_('Notifications'), max_length=10,
+        choices=DIGEST_CHOICES, default=DIGEST_IMMEDIATE,
+        help_text=_('How often to send notifications on new posts and topics'))
 
     def save(self, *args, **kwargs):
-        self.signature_html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](self.signature)
+        self.signature_html = render_markup(self.signature)
         super(PybbProfile, self).save(*args, **kwargs)
 
     @property
@@ -500,6 +685,69 @@ class ForumReadTracker(models.Model):
     time_stamp = models.DateTimeField(auto_now=True)
 
 
+class CompactReadTracker(models.Model):
+    """
+    Save per user forum read tracking in a single row: forum is readed up to time_stamp,
+    and topics readed after time_stamp are stored in topics field as "topic_id:microseconds" pairs.
+    Used by pybb.read_tracking.CompactReadTracking backend.
+    """
+    class Meta(object):
+        unique_together = ('user', 'forum')
+        verbose_name = _('Compact read tracker')
+        verbose_name_plural = _('Compact read trackers')
+
+    user = models.ForeignKey(User, related_name='+')
+    forum = models.ForeignKey(Forum, related_name='+')
+    time_stamp = models.DateTimeField(blank=True, null=True)
+    topics = models.TextField(blank=True, default='')
+
+    def get_topics(self):
+        """
+        Return dict with time when every topic in topics field was readed
+        """
+        marks = {}
+        for pair in self.topics.split(','):
+            if pair:
+                topic_id, microseconds = pair.split(':')
+                marks[int(topic_id)] = from_microseconds(int(microseconds))
+        return marks
+
+    def set_topics(self, marks):
+        self.topics = ','.join('%d:%d' % (topic_id, to_microseconds(marks[topic_id])) for topic_id in sorted(marks))
+
+
+class QueuedNotification(models.Model):
+    """
+    Post which topic subscribers are not notified yet,
+    or new topic which watch area watchers are not notified yet.
+    Queue is processed by pybb_send_notifications command.
+    """
+    class Meta(object):
+        ordering = ['created']
+        verbose_name = _('Queued notification')
+        verbose_name_plural = _('Queued notifications')
+
+    post = models.ForeignKey(Post, verbose_name=_('Post'), blank=True, null=True)
+    topic = models.ForeignKey(Topic, verbose_name=_('Topic'), blank=True, null=True)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+
+class DigestItem(models.Model):
+    """
+    Post or new topic waiting for the next digest email of the user.
+    Digests are sent by pybb_send_digests command.
+    """
+    class Meta(object):
+        ordering = ['created']
+        verbose_name = _('Digest item')
+        verbose_name_plural = _('Digest items')
+
+    user = models.ForeignKey(User, related_name='digest_items', verbose_name=_('User'))
+    post = models.ForeignKey(Post, verbose_name=_('Post'), blank=True, null=True)
+    topic = models.ForeignKey(Topic, verbose_name=_('Topic'), blank=True, null=True)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+
 class PollAnswer(models.Model):
     topic = models.ForeignKey(Topic, related_name='poll_answers', verbose_name=_('Topic'))
     text = models.CharField(max_length=255, verbose_name=_('Text'))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache of whole pages for anonymous users. Responses are marked with Surrogate-Key header,
+so reverse proxy can cache them too. When objects are changed, signals purge their surrogate
+keys: pages in PYBB_PAGE_CACHE are checked against version of every surrogate key, and
+PYBB_PURGE_BACKEND is asked to purge these keys from reverse proxy.
+"""
+
+from hashlib import sha1
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import translation
+from django.utils.importlib import import_module
+
+from pybb import defaults
+from pybb.fragment_cache import get_versions
+
+PAGE_KEY = 'pybb_page:%s:%s'
+SURROGATE_VERSION_KEY = 'pybb_surrogate:%s'
+
+INDEX_KEY = 'pybb-index'
+LATEST_KEY = 'pybb-latest'
+FORUM_KEY = 'pybb-forum-%s'
+FORUM_TOPICS_KEY = 'pybb-forum-topics-%s'
+TOPIC_KEY = 'pybb-topic-%s'
+WATCH_AREA_KEY = 'pybb-area-%s'
+
+
+class LocalPurgeBackend(object):
+    """
+    Remember purged keys in memory of current process, for tests and debugging
+    """
+
+    def __init__(self):
+        self.purged = []
+
+    def purge(self, keys):
+        self.purged.extend(keys)
+
+
+def get_page_cache():
+    """
+    Return cache configured with PYBB_PAGE_CACHE or None if page caching is disabled
+    """
+    if not defaults.PYBB_PAGE_CACHE:
+        return None
+    from django.core.cache import get_cache
+    return get_cache(defaults.PYBB_PAGE_CACHE)
+
+
+_backends = {}
+
+def get_purge_backend():
+    """
+    Return instance of backend configured with PYBB_PURGE_BACKEND or None
+    """
+    path = defaults.PYBB_PURGE_BACKEND
+    if not path:
+        return None
+    if path not in _backends:
+        module_name, class_name = path.rsplit('.', 1)
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError):
+            raise ImproperlyConfigured('Could not load purge backend %s' % path)
+        _backends[path] = backend_class()
+    return _backends[path]
+
+
+def is_enabled():
+    return bool(defaults.PYBB_PAGE_CACHE or defaults.PYBB_PURGE_BACKEND)
+
+
+def page_key(request):
+    return PAGE_KEY % (translation.get_language(), sha1(request.get_full_path()).hexdigest())
+
+
+def get_key_versions(keys):
+    """
+    Return dict of current versions of surrogate keys, or None if page cache is disabled
+    """
+    cache = get_page_cache()
+    if cache is None:
+        return None
+    return dict(zip(keys, get_versions(cache, [SURROGATE_VERSION_KEY % key for key in keys])))
+
+
+def get_cached_response(request, versions):
+    """
+    Return cached response for request, if none of its surrogate keys was purged since it was cached
+    """
+    cache = get_page_cache()
+    if cache is None:
+        return None
+    cached = cache.get(page_key(request))
+    if cached is None or cached[0] != versions:
+        return None
+    return cached[1]
+
+
+def cache_response(request, response, keys, versions):
+    """
+    Set Surrogate-Key header and store response. `versions` are versions of keys read
+    before response was rendered, so purge during rendering makes response outdated.
+    """
+    response['Surrogate-Key'] = ' '.join(keys)
+    cache = get_page_cache()
+    if cache is not None:
+        cache.set(page_key(request), (versions, response), defaults.PYBB_PAGE_CACHE_TIMEOUT)
+
+
+def purge(*keys):
+    """
+    Make cached pages with any of surrogate keys outdated
+    """
+    cache = get_page_cache()
+    if cache is not None:
+        for key in keys:
+            try:
+                cache.incr(SURROGATE_VERSION_KEY % key)
+            except ValueError:
+                # Version is not started yet, or evicted
+                pass
+    backend = get_purge_backend()
+    if backend is not None:
+        backend.purge(keys)
+
+
+def purge_topic(topic):
+    """
+    Purge pages which display topic: topic, its forum, watch areas, index and latest topics.
+    Watch areas remembered before topic was saved or deleted are purged too.
+    """
+    if not is_enabled():
+        return
+    from pybb.models import WatchAreaTopic
+    area_ids = set(WatchAreaTopic.objects.filter(topic=topic.pk).values_list('watch_area_id', flat=True))
+    area_ids.update(getattr(topic, '_pybb_old_area_ids', ()))
+    purge(INDEX_KEY, LATEST_KEY, FORUM_KEY % topic.forum_id, TOPIC_KEY % topic.pk,
+          *[WATCH_AREA_KEY % area_id for area_id in area_ids])
+
+
+def purge_forums(forum_ids):
+    """
+    Purge pages which display forums: forums, all their topics, watch areas with their topics,
+    index and latest topics. Used when forums or their categories are changed, e.g. hidden.
+    """
+    if not is_enabled():
+        return
+    from pybb.models import WatchAreaTopic
+    forum_ids = list(forum_ids)
+    area_ids = WatchAreaTopic.objects.filter(topic__forum__in=forum_ids).order_by()\
+        .values_list('watch_area_id', flat=True).distinct()
+    purge(INDEX_KEY, LATEST_KEY,
+          *([FORUM_KEY % forum_id for forum_id in forum_ids] +
+            [FORUM_TOPICS_KEY % forum_id for forum_id in forum_ids] +
+            [WATCH_AREA_KEY % area_id for area_id in area_ids]))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+Paginators with stored or cached total count, and keyset (seek) pagination.
+Links to the next and previous pages carry the ordering values of the last or first
+object of the current page, and these pages are loaded with an indexed range
+condition instead of OFFSET. Links to other pages fall back to OFFSET.
+"""
+
+from django.db.models import Q, BooleanField, DateTimeField
+
+from pure_pagination import Paginator
+from pure_pagination.paginator import Page
+
+from pybb.util import to_microseconds, from_microseconds
+
+
+class CountPaginator(Paginator):
+    """
+    Paginator which uses given `count` as total number of objects instead of COUNT(*) query
+    """
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super(CountPaginator, self).__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            self._count = count
+
+
+class KeysetPage(Page):
+
+    def _other_page_querystring(self, page_number):
+        querystring = 'page=%s' % page_number
+        number = getattr(self, 'number', None)
+        if number is not None and self.object_list:
+            if page_number == number + 1:
+                cursor = self.paginator.get_cursor(self.object_list[-1])
+                if cursor:
+                    querystring += '&after=%s' % cursor
+            elif page_number == number - 1:
+                cursor = self.paginator.get_cursor(self.object_list[0])
+                if cursor:
+                    querystring += '&before=%s' % cursor
+        return querystring
+
+
+class KeysetPaginator(CountPaginator):
+    """
+    Paginator for queryset ordered by `ordering`, last field of ordering should be unique.
+    """
+
+    def __init__(self, object_list, per_page, ordering, request=None, **kwargs):
+        super(KeysetPaginator, self).__init__(object_list.order_by(*ordering), per_page, **kwargs)
+        self.fields = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+        self.after = self.before = None
+        if request is not None:
+            self.after = self.parse_cursor(request.GET.get('after'))
+            self.before = self.parse_cursor(request.GET.get('before'))
+
+    def get_cursor(self, obj):
+        values = []
+        for name, desc in self.fields:
+            value = getattr(obj, name)
+            if value is None:
+                return None
+            if isinstance(value, bool):
+                value = int(value)
+            elif hasattr(value, 'microsecond'):
+                value = to_microseconds(value)
+            values.append(str(value))
+        return '.'.join(values)
+
+    def parse_cursor(self, cursor):
+        if not cursor:
+            return None
+        values = []
+        try:
+            parts = cursor.split('.')
+            if len(parts) != len(self.fields):
+                return None
+            for (name, desc), value in zip(self.fields, parts):
+                field = self.object_list.model._meta.get_field(name)
+                if isinstance(field, BooleanField):
+                    value = value == '1'
+                elif isinstance(field, DateTimeField):
+                    value = from_microseconds(int(value))
+                else:
+                    value = int(value)
+                values.append(value)
+        except ValueError:
+            return None
+        return values
+
+    def seek(self, values, forward):
+        """
+        Return condition for objects after (forward) or before given ordering values
+        """
+        condition = None
+        equal = {}
+        for (name, desc), value in zip(self.fields, values):
+            lookup = desc == forward and 'lt' or 'gt'
+            part = Q(**dict(equal, **{'%s__%s' % (name, lookup): value}))
+            condition = part if condition is None else condition | part
+            equal[name] = value
+        return condition
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if self.after is not None:
+            object_list = list(self.object_list.filter(self.seek(self.after, True))[:self.per_page])
+        elif self.before is not None:
+            reverse_ordering = [desc and name or '-' + name for name, desc in self.fields]
+            object_list = list(self.object_list.filter(self.seek(self.before, False))
+                                               .order_by(*reverse_ordering)[:self.per_page])
+            object_list.reverse()
+        else:
+            bottom = (number - 1) * self.per_page
+            object_list = list(self.object_list[bottom:bottom + self.per_page])
+        return KeysetPage(object_list, number, self)
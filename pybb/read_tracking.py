@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Read tracking backends. Backend is selected with PYBB_READ_TRACKING_BACKEND setting.
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+from django.utils.importlib import import_module
+
+from pybb import defaults
+from pybb.models import Topic, TopicReadTracker, ForumReadTracker, CompactReadTracker
+
+try:
+    from django.utils.timezone import now as tznow
+except ImportError:
+    import datetime
+    tznow = datetime.datetime.now
+
+
+class TrackerReadTracking(object):
+    """
+    Store one ForumReadTracker row for every readed forum and
+    one TopicReadTracker row for every topic readed after its forum.
+    """
+
+    def topics_unread(self, topics, user):
+        """
+        Set .unread for all topics, topics may belong to different forums.
+        """
+        forum_marks = {}
+        forum_ids = set(topic.forum_id for topic in topics)
+        for forum_id, time_stamp in ForumReadTracker.objects.filter(user=user, forum__in=forum_ids)\
+                                                            .values_list('forum_id', 'time_stamp'):
+            forum_marks[forum_id] = max(time_stamp, forum_marks.get(forum_id, time_stamp))
+        topic_marks = {}
+        for topic_id, time_stamp in TopicReadTracker.objects.filter(user=user, topic__in=topics)\
+                                                            .values_list('topic_id', 'time_stamp'):
+            topic_marks[topic_id] = max(time_stamp, topic_marks.get(topic_id, time_stamp))
+        for topic in topics:
+            topic.unread = True
+            if topic.updated:
+                marks = [mark for mark in (forum_marks.get(topic.forum_id), topic_marks.get(topic.id)) if mark]
+                if marks and topic.updated <= max(marks):
+                    topic.unread = False
+
+    def forums_unread(self, forums, user):
+        """
+        Set .unread for all forums with topics.
+        """
+        for forum in forums:
+            if forum.topic_count:
+                forum.unread = True
+        forum_marks = ForumReadTracker.objects.filter(user=user, forum__in=forums)\
+                                              .values_list('forum_id', 'time_stamp')
+        forum_dict = dict(((forum.id, forum) for forum in forums))
+        for forum_id, time_stamp in forum_marks:
+            if (forum_dict[forum_id].updated is None) or (forum_dict[forum_id].updated <= time_stamp):
+                forum_dict[forum_id].unread = False
+
+    def mark_topic_read(self, topic, user):
+        """
+        Mark topic as readed, and whole forum if there are no unread topics left in it.
+        """
+        try:
+            forum_mark = ForumReadTracker.objects.get(forum=topic.forum_id, user=user)
+        except ForumReadTracker.DoesNotExist:
+            forum_mark = None
+        if (forum_mark is None) or (topic.updated and forum_mark.time_stamp < topic.updated):
+            # Mark topic as readed
+            if not TopicReadTracker.objects.filter(topic=topic, user=user).update(time_stamp=tznow()):
+                TopicReadTracker.objects.create(topic=topic, user=user)
+
+            # Check, if there are any unread topics in forum.
+            # Only topics updated after forum mark could be unread, forum is readed
+            # when every one of them has topic mark not older than the topic itself.
+            # The check stops at the first unread topic, but it still scans topics updated
+            # after forum mark (whole forum, if it was never marked) while they are readed.
+            topics = Topic.objects.filter(forum=topic.forum_id, updated__isnull=False)
+            marks = TopicReadTracker.objects.filter(user=user, topic__forum=topic.forum_id,
+                                                    time_stamp__gte=F('topic__updated'))
+            if forum_mark is not None:
+                topics = topics.filter(updated__gt=forum_mark.time_stamp)
+            if not topics.exclude(pk__in=marks.values('topic')).exists():
+                # Clear all topic marks for this forum, mark forum as readed
+                TopicReadTracker.objects.filter(user=user, topic__forum=topic.forum_id).delete()
+                if forum_mark is None:
+                    ForumReadTracker.objects.create(forum_id=topic.forum_id, user=user)
+                else:
+                    forum_mark.save()
+
+    def mark_forums_read(self, forums, users):
+        """
+        Mark all forums as readed for all users with constant number of queries:
+        existing forum marks are updated, missing are inserted, topic marks are deleted.
+        """
+        now = tznow()
+        forum_ids = set(forum.pk for forum in forums)
+        user_ids = set(user.pk for user in users)
+        forum_marks = ForumReadTracker.objects.filter(user__in=user_ids, forum__in=forum_ids)
+        existing = set(forum_marks.values_list('user_id', 'forum_id'))
+        forum_marks.update(time_stamp=now)
+        ForumReadTracker.objects.bulk_create([ForumReadTracker(user_id=user_id, forum_id=forum_id, time_stamp=now)
+                                              for user_id in user_ids for forum_id in forum_ids
+                                              if (user_id, forum_id) not in existing])
+        TopicReadTracker.objects.filter(user__in=user_ids, topic__forum__in=forum_ids).delete()
+
+
+class CompactReadTracking(object):
+    """
+    Store one CompactReadTracker row for every user and forum with forum read time
+    and times when topics updated after it were readed.
+    """
+
+    def get_marks(self, forum_ids, user):
+        return dict((mark.forum_id, mark) for mark in
+                    CompactReadTracker.objects.filter(user=user, forum__in=forum_ids))
+
+    def topics_unread(self, topics, user):
+        forum_marks = self.get_marks(set(topic.forum_id for topic in topics), user)
+        topic_marks = {}
+        for forum_mark in forum_marks.itervalues():
+            topic_marks.update(forum_mark.get_topics())
+        for topic in topics:
+            topic.unread = True
+            if topic.updated:
+                forum_mark = forum_marks.get(topic.forum_id)
+                marks = [mark for mark in (forum_mark and forum_mark.time_stamp, topic_marks.get(topic.id)) if mark]
+                if marks and topic.updated <= max(marks):
+                    topic.unread = False
+
+    def forums_unread(self, forums, user):
+        forum_marks = self.get_marks([forum.id for forum in forums], user)
+        for forum in forums:
+            if forum.topic_count:
+                forum_mark = forum_marks.get(forum.id)
+                forum.unread = not (forum_mark and forum_mark.time_stamp and
+                                    (forum.updated is None or forum.updated <= forum_mark.time_stamp))
+
+    def mark_topic_read(self, topic, user):
+        try:
+            forum_mark = CompactReadTracker.objects.get(forum=topic.forum_id, user=user)
+        except CompactReadTracker.DoesNotExist:
+            forum_mark = None
+        time_stamp = forum_mark and forum_mark.time_stamp
+        marks = forum_mark.get_topics() if forum_mark else {}
+        # Nothing is written when topic is already readed
+        if not topic.updated:
+            if time_stamp or topic.id in marks:
+                return
+        elif (time_stamp and topic.updated <= time_stamp) or (topic.id in marks and topic.updated <= marks[topic.id]):
+            return
+        now = tznow()
+        marks[topic.id] = now
+
+        # Only topics updated after forum mark could be unread, marks of other topics are not needed anymore.
+        # Only marked topics are loaded, the rest of the forum is checked with EXISTS query.
+        marked = Topic.objects.filter(pk__in=marks.keys(), updated__isnull=False)
+        topics = Topic.objects.filter(forum=topic.forum_id, updated__isnull=False)
+        if time_stamp:
+            marked = marked.filter(updated__gt=time_stamp)
+            topics = topics.filter(updated__gt=time_stamp)
+        updated = dict(marked.values_list('id', 'updated'))
+        marks = dict((topic_id, mark) for topic_id, mark in marks.iteritems() if topic_id in updated)
+        if all(updated[topic_id] <= mark for topic_id, mark in marks.iteritems()) and \
+           not topics.exclude(pk__in=marks.keys()).exists():
+            time_stamp = now
+            marks = {}
+        if forum_mark is None:
+            forum_mark, new = CompactReadTracker.objects.get_or_create(forum_id=topic.forum_id, user=user)
+        forum_mark.time_stamp = time_stamp or None
+        forum_mark.set_topics(marks)
+        forum_mark.save()
+
+    def mark_forums_read(self, forums, users):
+        now = tznow()
+        forum_ids = set(forum.pk for forum in forums)
+        user_ids = set(user.pk for user in users)
+        forum_marks = CompactReadTracker.objects.filter(user__in=user_ids, forum__in=forum_ids)
+        existing = set(forum_marks.values_list('user_id', 'forum_id'))
+        forum_marks.update(time_stamp=now, topics='')
+        CompactReadTracker.objects.bulk_create([CompactReadTracker(user_id=user_id, forum_id=forum_id, time_stamp=now)
+                                                for user_id in user_ids for forum_id in forum_ids
+                                                if (user_id, forum_id) not in existing])
+
+
+_backends = {}
+
+def get_read_tracking():
+    """
+    Return instance of backend configured with PYBB_READ_TRACKING_BACKEND
+    """
+    path = defaults.PYBB_READ_TRACKING_BACKEND
+    if path not in _backends:
+        module_name, class_name = path.rsplit('.', 1)
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError):
+            raise ImproperlyConfigured('Could not load read tracking backend %s' % path)
+        _backends[path] = backend_class()
+    return _backends[path]
@@ -2,30 +2,78 @@
 
 from django.contrib.auth.models import User, Permission
 from django.conf import settings
-from django.db.models import ObjectDoesNotExist
-from django.db.models.signals import post_save, post_delete
+from django.db.models import ObjectDoesNotExist, F
+from django.contrib.gis.geos import GEOSGeometry
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete, post_delete, m2m_changed
 
 from pybb.subscription import notify_topic_subscribers, notify_area_watchers
 from pybb import defaults
+from pybb.util import moderated_forums_cache_key
 
 
 def post_saved(instance, **kwargs):
-    notify_topic_subscribers(instance)
+    # Post is saved more than once when added through the form, and again when edited
+    if kwargs['created']:
+        notify_topic_subscribers(instance)
 
     if instance.user.get_profile().autosubscribe:
         instance.topic.subscribers.add(instance.user)
 
     if kwargs['created']:
         profile = instance.user.get_profile()
-        profile.post_count = instance.user.posts.count()
-        profile.save()
+        if defaults.PYBB_DELTA_COUNTERS:
+            add_profile_post_count(profile, 1)
+        else:
+            profile.post_count = instance.user.posts.count()
+            profile.save()
 
 def post_deleted(instance, **kwargs):
     profile = instance.user.get_profile()
-    profile.post_count = instance.user.posts.count()
-    profile.save()
+    if defaults.PYBB_DELTA_COUNTERS:
+        add_profile_post_count(profile, -1)
+    else:
+        profile.post_count = instance.user.posts.count()
+        profile.save()
+
+def add_profile_post_count(profile, delta):
+    """
+    Shift profile post counter with a single UPDATE, without saving the whole profile.
+    UPDATE sends no signals, so fragments displaying the profile are invalidated here.
+    """
+    from pybb.fragment_cache import bump_versions
+    profile.post_count += delta
+    profile.__class__.objects.filter(pk=profile.pk).update(post_count=F('post_count') + delta)
+    bump_versions((profile.__class__, profile.pk))
+
+def _geometry(instance):
+    """
+    Return place of topic or fence of watch area as stored on instance, without converting
+    value loaded from database
+    """
+    from models import Topic
+    return instance.__dict__.get('place' if isinstance(instance, Topic) else 'fence')
+
+def geometry_loaded(instance, **kwargs):
+    instance._pybb_geometry = _geometry(instance)
+
+def geometry_changed(instance):
+    """
+    Tell if place of topic or fence of watch area differs from the one it was loaded or last saved with
+    """
+    old, new = getattr(instance, '_pybb_geometry', None), _geometry(instance)
+    if old is new:
+        return False
+    if old is None or new is None:
+        return True
+    old, new = [g if isinstance(g, GEOSGeometry) else GEOSGeometry(g) for g in (old, new)]
+    return old != new
 
 def topic_saved(instance, **kwargs):
+    # Membership depends only on place, other saves (views, sticky, closed) keep it
+    if kwargs['created'] or geometry_changed(instance):
+        instance.update_watch_areas()
+        instance._pybb_geometry = _geometry(instance)
+
     # We're only concerned with when a topic is created.
     if not kwargs['created']:
         return
@@ -33,10 +81,90 @@ def topic_saved(instance, **kwargs):
     notify_area_watchers(instance)
 
 def watch_area_saved(instance, **kwargs):
+    if kwargs['created'] or geometry_changed(instance):
+        instance.update_topics()
+        instance._pybb_geometry = _geometry(instance)
+
     if kwargs['created']:
         if instance.user.get_profile().autosubscribe:
             instance.watchers.add(instance.user)
 
+def forum_moderators_changed(instance, action, reverse, pk_set, **kwargs):
+    if not defaults.PYBB_PERMISSION_CACHE or action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # Forums of user are changed
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        user_ids = list(instance.moderators.values_list('pk', flat=True))
+    else:
+        user_ids = pk_set
+    from django.core.cache import get_cache
+    get_cache(defaults.PYBB_PERMISSION_CACHE).delete_many([moderated_forums_cache_key(pk) for pk in user_ids])
+
+def fragments_changed(instance, **kwargs):
+    """
+    Increment fragment cache versions of changed object and objects which fragments display it
+    """
+    if not defaults.PYBB_FRAGMENT_CACHE:
+        return
+    from pybb.fragment_cache import bump_versions
+    from models import Post, Topic, Forum, Category, Attachment
+    objects = [(instance.__class__, instance.pk)]
+    try:
+        if isinstance(instance, Attachment):
+            objects = [(Post, instance.post_id)]
+        elif isinstance(instance, Post):
+            forum = instance.topic.forum
+            objects += [(Topic, instance.topic_id), (Forum, forum.pk), (Category, forum.category_id)]
+        elif isinstance(instance, Topic):
+            objects += [(Forum, instance.forum_id), (Category, instance.forum.category_id)]
+        elif isinstance(instance, Forum):
+            objects += [(Category, instance.category_id)]
+    except ObjectDoesNotExist:
+        # Parent object is already deleted and bumped itself
+        pass
+    bump_versions(*objects)
+
+def topic_areas_changing(instance, **kwargs):
+    """
+    Remember watch areas of topic before they are rebuilt or deleted, so their pages are purged too
+    """
+    from pybb import page_cache
+    if not page_cache.is_enabled() or instance.pk is None:
+        return
+    if kwargs['signal'] is pre_save and not geometry_changed(instance):
+        # Membership is not rebuilt
+        instance.__dict__.pop('_pybb_old_area_ids', None)
+        return
+    from models import WatchAreaTopic
+    instance._pybb_old_area_ids = list(WatchAreaTopic.objects.filter(topic=instance.pk)\
+        .values_list('watch_area_id', flat=True))
+
+def pages_changed(instance, **kwargs):
+    """
+    Purge cached pages which display changed post, topic, forum, category or watch area
+    """
+    from pybb import page_cache
+    if not page_cache.is_enabled():
+        return
+    from models import Post, Topic, Forum, WatchArea
+    try:
+        if isinstance(instance, Post):
+            page_cache.purge_topic(instance.topic)
+        elif isinstance(instance, Topic):
+            page_cache.purge_topic(instance)
+        elif isinstance(instance, Forum):
+            page_cache.purge_forums([instance.pk])
+        elif isinstance(instance, WatchArea):
+            page_cache.purge(page_cache.INDEX_KEY, page_cache.WATCH_AREA_KEY % instance.pk)
+        else:
+            # Forums of deleted category are deleted and purged themselves
+            page_cache.purge_forums(Forum.objects.filter(category=instance.pk).values_list('pk', flat=True))
+    except ObjectDoesNotExist:
+        # Topic of post is already deleted and purged itself
+        pass
+
 def user_saved(instance, created, **kwargs):
     if not created:
         return
@@ -52,11 +180,26 @@ def user_saved(instance, created, **kwargs):
         Profile(user=instance).save()
 
 def setup_signals():
-    from models import Post, Topic, WatchArea
+    from models import Post, Topic, Forum, Category, Attachment, WatchArea
     post_save.connect(post_saved, sender=Post)
     post_delete.connect(post_deleted, sender=Post)
     post_save.connect(topic_saved, sender=Topic)
+    post_init.connect(geometry_loaded, sender=Topic)
+    post_init.connect(geometry_loaded, sender=WatchArea)
     post_save.connect(watch_area_saved, sender=WatchArea)
+    m2m_changed.connect(forum_moderators_changed, sender=Forum.moderators.through)
+    fragment_models = [Post, Topic, Forum, Category, Attachment, User]
+    if settings.AUTH_PROFILE_MODULE == 'pybb.Profile':
+        from models import Profile
+        fragment_models.append(Profile)
+    for model in fragment_models:
+        post_save.connect(fragments_changed, sender=model)
+        post_delete.connect(fragments_changed, sender=model)
+    pre_save.connect(topic_areas_changing, sender=Topic)
+    pre_delete.connect(topic_areas_changing, sender=Topic)
+    for model in (Post, Topic, Forum, Category, WatchArea):
+        post_save.connect(pages_changed, sender=model)
+        post_delete.connect(pages_changed, sender=model)
 
     if defaults.PYBB_AUTO_USER_PERMISSIONS:
         post_save.connect(user_saved, sender=User)
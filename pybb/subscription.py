@@ -5,92 +5,268 @@ from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 from django.utils import translation
 from django.contrib.sites.models import Site
+from django.db import transaction
 from django import forms
 
 from pybb import defaults
+from pybb.util import get_profile_model
 
 if defaults.PYBB_USE_DJANGO_MAILER:
     try:
-        from mailer import send_mail
+        from mailer import send_mass_mail
     except ImportError:
-        from django.core.mail import send_mail
+        from django.core.mail import send_mass_mail
 else:
-    from django.core.mail import send_mail
+    from django.core.mail import send_mass_mail
 
 
 email_validator = forms.EmailField()
 
-def notify_topic_subscribers(post):
-    topic = post.topic
-    if post != topic.head:
-        for user in topic.subscribers.all():
-            if user != post.user:
-                try:
-                    email_validator.clean(user.email)
-                except:
-                    #invalid email
-                    continue
-                old_lang = translation.get_language()
-                lang = user.get_profile().language or settings.LANGUAGE_CODE
-                translation.activate(lang)
-                delete_url = reverse('pybb:delete_subscription', args=[post.topic.id])
-                current_site = Site.objects.get_current()
-                subject = render_to_string('pybb/mail_templates/subscription_email_subject.html',
-                                           { 'site': current_site,
-                                             'post': post
-                                           })
-                # Email subject *must not* contain newlines
-                subject = ''.join(subject.splitlines())
-                message = render_to_string('pybb/mail_templates/subscription_email_body.html',
-                                           { 'site': current_site,
-                                             'post': post,
-                                             'delete_url': delete_url,
-                                             })
-                send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [user.email], fail_silently=True)
-                translation.activate(old_lang)
+def get_user_languages(users):
+    """
+    Return dict with language for every user, loading all profiles with one query
+    """
+    profiles = get_profile_model().objects.filter(user__in=users).values_list('user_id', 'language')
+    languages = dict(profiles)
+    return dict((user.pk, languages.get(user.pk) or settings.LANGUAGE_CODE) for user in users)
 
+def valid_recipients(users):
+    """
+    Return users with valid email
+    """
+    recipients = []
+    for user in users:
+        try:
+            email_validator.clean(user.email)
+        except:
+            #invalid email
+            continue
+        recipients.append(user)
+    return recipients
 
-def notify_area_watchers(topic):
-    from pybb.models import WatchArea
+def render_message(subject_template, body_template, context, lang):
+    """
+    Render (subject, message) pair in given language
+    """
+    old_lang = translation.get_language()
+    translation.activate(lang)
+    try:
+        subject = render_to_string(subject_template, context)
+        # Email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        message = render_to_string(body_template, context)
+    finally:
+        translation.activate(old_lang)
+    return subject, message
 
-    place = topic.place
-    watch_areas = WatchArea.objects.filter(fence__intersects=place).prefetch_related('watchers')
-    watchers = {}
+def render_notifications(users, subject_template, body_template, context):
+    """
+    Render one message for every user with valid email.
+    Templates are rendered once per language and reused for all users with that language.
+    Return list of (subject, message, from_email, recipient_list) tuples for send_mass_mail.
+    """
+    recipients = valid_recipients(users)
+    if not recipients:
+        return []
+
+    languages = get_user_languages(recipients)
+    rendered = {}
+    messages = []
+    for user in recipients:
+        lang = languages[user.pk]
+        if lang not in rendered:
+            rendered[lang] = render_message(subject_template, body_template, context, lang)
+        subject, message = rendered[lang]
+        messages.append((subject, message, settings.DEFAULT_FROM_EMAIL, [user.email]))
+    return messages
+
+def defer_to_digest(users, post=None, topic=None):
+    """
+    Store digest item for every user who receives notifications in digest.
+    Return users who should be notified immediately.
+    """
+    from pybb.models import DigestItem, DIGEST_IMMEDIATE
+
+    if not users:
+        return []
+    digest_users = set(get_profile_model().objects.filter(user__in=users)
+                                                  .exclude(digest=DIGEST_IMMEDIATE)
+                                                  .values_list('user_id', flat=True))
+    if digest_users:
+        DigestItem.objects.bulk_create([DigestItem(user_id=user_id, post=post, topic=topic)
+                                        for user_id in digest_users])
+    return [user for user in users if user.pk not in digest_users]
+
+def topic_notifications(post):
+    """
+    Return messages for subscribers of post's topic
+    """
+    topic = post.topic
+    # Head post is not set yet while the first post of topic is being saved
+    if topic.head_post_id in (None, post.pk):
+        return []
+    users = [user for user in topic.subscribers.all() if user != post.user]
+    users = defer_to_digest(users, post=post)
+    return render_notifications(users,
+                                'pybb/mail_templates/subscription_email_subject.html',
+                                'pybb/mail_templates/subscription_email_body.html',
+                                { 'site': Site.objects.get_current(),
+                                  'post': post,
+                                  'delete_url': reverse('pybb:delete_subscription', args=[topic.id]),
+                                  })
+
+def send_notifications(messages):
+    """
+    Send all messages over one mail connection
+    """
+    if messages:
+        send_mass_mail(messages, fail_silently=True)
+
+def area_notifications(topic):
+    """
+    Return messages for watchers of watch areas containing the topic.
+    Every watcher gets one message listing all his watch areas with this topic,
+    content is rendered once per language and set of watch areas.
+    """
+    watch_areas = topic.watch_areas.all().prefetch_related('watchers')
 
     # Construct a mapping from user primary key to a tuple of
     # (user, [watch areas that contain this topic]).
+    watchers = {}
     for watch_area in watch_areas:
-        users = watch_area.watchers.all()
-        for user in users:
+        for user in watch_area.watchers.all():
             if user.pk in watchers:
                 watchers[user.pk][1].append(watch_area)
             else:
                 watchers[user.pk] = (user, [watch_area])
 
-    for user, watch_areas in watchers.itervalues():
-        if user != topic.user:
-            try:
-                email_validator.clean(user.email)
-            except:
-                #invalid email
-                continue
-            old_lang = translation.get_language()
-            lang = user.get_profile().language or settings.LANGUAGE_CODE
-            translation.activate(lang)
-            manage_url = reverse('pybb:edit_profile', args=[])
-            current_site = Site.objects.get_current()
-            subject = render_to_string('pybb/mail_templates/watch_area_subscription_email_subject.html',
-                                       { 'site': current_site,
-                                         'watch_areas': watch_areas,
-                                         'topic': topic
-                                       })
-            # Email subject *must not* contain newlines
-            subject = ''.join(subject.splitlines())
-            message = render_to_string('pybb/mail_templates/watch_area_subscription_email_body.html',
-                                       { 'site': current_site,
-                                         'topic': topic,
-                                         'watch_areas': watch_areas,
-                                         'manage_url': manage_url,
-                                         })
-            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [user.email], fail_silently=True)
-            translation.activate(old_lang)
+    users = [user for user, areas in watchers.itervalues() if user != topic.user]
+    recipients = valid_recipients(defer_to_digest(users, topic=topic))
+    if not recipients:
+        return []
+
+    languages = get_user_languages(recipients)
+    context = { 'site': Site.objects.get_current(),
+                'topic': topic,
+                'manage_url': reverse('pybb:edit_profile', args=[]),
+                }
+    rendered = {}
+    messages = []
+    for user in recipients:
+        user_areas = watchers[user.pk][1]
+        key = (languages[user.pk], tuple(area.pk for area in user_areas))
+        if key not in rendered:
+            context['watch_areas'] = user_areas
+            rendered[key] = render_message('pybb/mail_templates/watch_area_subscription_email_subject.html',
+                                           'pybb/mail_templates/watch_area_subscription_email_body.html',
+                                           context, key[0])
+        subject, message = rendered[key]
+        messages.append((subject, message, settings.DEFAULT_FROM_EMAIL, [user.email]))
+    return messages
+
+def send_queued_notifications(batch_size=100):
+    """
+    Send and remove queued notifications, `batch_size` items at a time.
+    Return number of processed queue items.
+    """
+    processed = 0
+    while True:
+        count = send_queued_batch(batch_size)
+        if not count:
+            return processed
+        processed += count
+
+@transaction.commit_on_success
+def send_queued_batch(batch_size):
+    """
+    Send and remove one batch of queued notifications. Rows of the batch are locked until
+    they are removed, so concurrent run waits for them instead of sending them again.
+    """
+    from pybb.models import QueuedNotification
+
+    # Nullable side of outer join can't be locked, so rows are locked without select_related
+    ids = list(QueuedNotification.objects.select_for_update().values_list('pk', flat=True)[:batch_size])
+    if not ids:
+        return 0
+    batch = list(QueuedNotification.objects.filter(pk__in=ids)
+                                           .select_related('post', 'post__topic', 'post__user', 'topic'))
+    messages = []
+    for item in batch:
+        if item.post_id is not None:
+            messages.extend(topic_notifications(item.post))
+        if item.topic_id is not None:
+            messages.extend(area_notifications(item.topic))
+    send_notifications(messages)
+    QueuedNotification.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+def send_digests(period, batch_size=100):
+    """
+    Send one email with all pending digest items to every user with given digest period.
+    Items left by users who switched back to immediate notifications are sent as well.
+    Users are processed `batch_size` at a time. Return number of sent digests.
+    """
+    from pybb.models import DigestItem, WatchAreaTopic, DIGEST_IMMEDIATE
+
+    profiles = get_profile_model().objects.filter(digest__in=[period, DIGEST_IMMEDIATE])
+    user_ids = list(DigestItem.objects.filter(user__in=profiles.values('user'))
+                                      .order_by().values_list('user', flat=True).distinct())
+    site = Site.objects.get_current()
+    sent = 0
+    for start in range(0, len(user_ids), batch_size):
+        batch_ids = user_ids[start:start + batch_size]
+        items = list(DigestItem.objects.filter(user__in=batch_ids)
+                                       .select_related('user', 'post', 'post__topic', 'post__user', 'topic', 'topic__user'))
+        users = {}
+        for item in items:
+            users.setdefault(item.user_id, (item.user, []))[1].append(item)
+
+        recipients = valid_recipients([user for user, user_items in users.itervalues()])
+        languages = get_user_languages(recipients)
+        messages = []
+        for user in recipients:
+            user_items = users[user.pk][1]
+            replies = {}
+            for item in user_items:
+                if item.post_id is not None:
+                    replies.setdefault(item.post.topic_id, (item.post.topic, []))[1].append(item.post)
+            # Queue rows come in no particular order, list posts and topics by post creation time
+            replies = replies.values()
+            for topic, posts in replies:
+                posts.sort(key=lambda post: post.created)
+            replies.sort(key=lambda reply: reply[1][0].created)
+            new_topics = [item.topic for item in user_items if item.topic_id is not None]
+            watch_areas = {}
+            if new_topics:
+                memberships = WatchAreaTopic.objects.filter(topic__in=new_topics, watch_area__watchers=user)\
+                                                    .select_related('watch_area')
+                for membership in memberships:
+                    watch_areas.setdefault(membership.topic_id, []).append(membership.watch_area)
+            context = { 'site': site,
+                        'user': user,
+                        'replies': replies,
+                        'new_topics': [(topic, watch_areas.get(topic.pk, [])) for topic in new_topics],
+                        'manage_url': reverse('pybb:edit_profile', args=[]),
+                        }
+            subject, message = render_message('pybb/mail_templates/digest_email_subject.html',
+                                              'pybb/mail_templates/digest_email_body.html',
+                                              context, languages[user.pk])
+            messages.append((subject, message, settings.DEFAULT_FROM_EMAIL, [user.email]))
+        send_notifications(messages)
+        DigestItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+        sent += len(messages)
+    return sent
+
+def notify_topic_subscribers(post):
+    if defaults.PYBB_NOTIFICATION_QUEUE:
+        from pybb.models import QueuedNotification
+        QueuedNotification.objects.get_or_create(post=post)
+    else:
+        send_notifications(topic_notifications(post))
+
+def notify_area_watchers(topic):
+    if defaults.PYBB_NOTIFICATION_QUEUE:
+        from pybb.models import QueuedNotification
+        QueuedNotification.objects.get_or_create(topic=topic)
+    else:
+        send_notifications(area_notifications(topic))
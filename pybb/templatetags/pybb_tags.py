@@ -25,8 +25,11 @@ try:
 except ImportError:
     pytils_enabled = False
 
-from pybb.models import TopicReadTracker, ForumReadTracker, PollAnswerUser
+from pybb.models import PollAnswerUser, Topic
 from pybb import defaults
+from pybb.util import get_moderated_forum_ids
+from pybb.read_tracking import get_read_tracking
+from pybb.fragment_cache import get_fragment_cache, fragment_key
 
 
 register = template.Library()
@@ -88,6 +91,44 @@ class PybbTimeNode(template.Node):
             return dateformat.format(context_time, 'd M, Y H:i')
 
 
+@register.tag
+def pybb_cache(parser, token):
+    """
+    Cache template fragment for anonymous users in PYBB_FRAGMENT_CACHE:
+
+        {% pybb_cache fragment_name object1 object2 ... %} ... {% endpybb_cache %}
+
+    Key of fragment includes current language and versions of given objects.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError('pybb_cache requires fragment name')
+    nodelist = parser.parse(('endpybb_cache',))
+    parser.delete_first_token()
+    return PybbCacheNode(nodelist, bits[1], [parser.compile_filter(bit) for bit in bits[2:]])
+
+
+class PybbCacheNode(template.Node):
+    def __init__(self, nodelist, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        cache = get_fragment_cache()
+        user = context.get('user')
+        # Pages of logged in users contain their read marks, subscriptions,
+        # edit links and time zone, so only anonymous variant is cached
+        if cache is None or user is None or user.is_authenticated():
+            return self.nodelist.render(context)
+        key = fragment_key(cache, self.fragment_name, [var.resolve(context) for var in self.vary_on])
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, defaults.PYBB_FRAGMENT_CACHE_TIMEOUT)
+        return value
+
+
 @register.simple_tag
 def pybb_link(object, anchor=u''):
     """
@@ -106,7 +147,7 @@ def pybb_topic_moderated_by(topic, user):
     Check if user is moderator of topic's forum.
     """
 
-    return user.is_superuser or (user in topic.forum.moderators.all())
+    return user.is_superuser or (topic.forum_id in get_moderated_forum_ids(user))
 
 @register.filter
 def pybb_editable_by(post, user):
@@ -118,7 +159,7 @@ def pybb_editable_by(post, user):
         return True
     if post.user == user:
         return True
-    if user in post.topic.forum.moderators.all():
+    if post.topic.forum_id in get_moderated_forum_ids(user):
         return True
     return False
 
@@ -136,27 +177,8 @@ def pybb_topic_unread(topics, user):
     Mark all topics in queryset/list with .unread for target user
     """
     topic_list = list(topics)
-    if user.is_authenticated():
-        for topic in topic_list:
-            topic.unread = True
-        try:
-            forum_mark = ForumReadTracker.objects.get(user=user, forum=topic_list[0].forum)
-        except:
-            forum_mark = None
-        qs = TopicReadTracker.objects.filter(
-                user=user,
-                topic__in=topic_list
-                ).select_related('topic')
-        if forum_mark:
-            qs = qs.filter(topic__updated__gt=forum_mark.time_stamp)
-            for topic in topic_list:
-                if topic.updated and (topic.updated <= forum_mark.time_stamp):
-                    topic.unread = False
-        topic_marks = list(qs)
-        topic_dict = dict(((topic.id, topic) for topic in topic_list))
-        for mark in topic_marks:
-            if topic_dict[mark.topic.id].updated and (topic_dict[mark.topic.id].updated <= mark.time_stamp):
-                topic_dict[mark.topic.id].unread = False
+    if user.is_authenticated() and topic_list:
+        get_read_tracking().topics_unread(topic_list, user)
     return topic_list
 
 
@@ -166,21 +188,24 @@ def pybb_forum_unread(forums, user):
     Check if forum has unread messages.
     """
     forum_list = list(forums)
-    if user.is_authenticated():
-        for forum in forum_list:
-            if forum.topic_count:
-                forum.unread = True
-        forum_marks = ForumReadTracker.objects.filter(
-                user=user,
-                forum__in=forum_list
-                ).select_related('forum')
-        forum_dict = dict(((forum.id, forum) for forum in forum_list))
-        for mark in forum_marks:
-            if (forum_dict[mark.forum.id].updated is None) or\
-               (forum_dict[mark.forum.id].updated <= mark.time_stamp):
-                forum_dict[mark.forum.id].unread = False
+    if user.is_authenticated() and forum_list:
+        get_read_tracking().forums_unread(forum_list, user)
     return forum_list
 
+@register.filter
+def pybb_topic_subscribed(topics, user):
+    """
+    Mark all topics in queryset/list with .subscribed for target user
+    """
+    topic_list = list(topics)
+    subscribed = set()
+    if user.is_authenticated() and topic_list:
+        subscribed = set(Topic.subscribers.through.objects.filter(user=user, topic__in=topic_list)
+                                                          .values_list('topic_id', flat=True))
+    for topic in topic_list:
+        topic.subscribed = topic.id in subscribed
+    return topic_list
+
 @register.filter
 def pybb_topic_inline_pagination(topic):
     page_count = int(math.ceil(topic.post_count / float(defaults.PYBB_TOPIC_PAGE_SIZE)))
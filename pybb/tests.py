@@ -4,7 +4,10 @@ import time, datetime
 import os
 
 from django.contrib.auth.models import User, Permission
+from django.conf import settings
 from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 from django.test import TestCase
@@ -84,6 +87,20 @@ class FeaturesTest(TestCase, SharedTestModule):
         user = User.objects.create_user(username='user2', password='user2', email='user2@example.com')
         self.assertEqual(user.get_profile().language, settings.LANGUAGE_CODE)
 
+    def test_profile_language_session(self):
+        self.login_client()
+        self.client.get(reverse('pybb:index'))
+        self.assertEqual(self.client.session['pybb_profile_language'], self.user.get_profile().language)
+        # Profile is not loaded again during the session
+        Profile.objects.filter(user=self.user).update(language='ru')
+        self.client.get(reverse('pybb:index'))
+        self.assertNotEqual(self.client.session.get('django_language'), 'ru')
+        # Profile edit syncs language on next request
+        values = self.get_form_values(self.client.get(reverse('pybb:edit_profile')), 'profile-edit')
+        self.client.post(reverse('pybb:edit_profile'), data=values)
+        self.client.get(reverse('pybb:index'))
+        self.assertEqual(self.client.session['django_language'], 'ru')
+
     def test_profile_edit(self):
         # Self profile edit
         self.login_client()
@@ -334,6 +351,80 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(ForumReadTracker.objects.filter(user=self.user).count(), 1)
         self.assertEqual(ForumReadTracker.objects.filter(user=self.user, forum=self.forum).count(), 1)
 
+    def test_topic_unread_many_forums(self):
+        from pybb.templatetags.pybb_tags import pybb_topic_unread
+        forum_2 = Forum.objects.create(name='xfoo2', description='bar', category=self.category)
+        topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+        Post.objects.create(topic=topic_2, user=self.user, body='one')
+        topic_3 = Topic.objects.create(name='topic_3', forum=forum_2, user=self.user)
+        Post.objects.create(topic=topic_3, user=self.user, body='two')
+        TopicReadTracker.objects.create(topic=topic_2, user=self.user)
+        ForumReadTracker.objects.create(forum=forum_2, user=self.user)
+        topics = Topic.objects.filter(pk__in=[self.topic.pk, topic_2.pk, topic_3.pk]).order_by('pk')
+        with self.assertNumQueries(3):
+            topics = pybb_topic_unread(topics, self.user)
+        self.assertEqual([topic.unread for topic in topics], [True, False, False])
+
+    def test_topic_subscribed(self):
+        from pybb.templatetags.pybb_tags import pybb_topic_subscribed
+        topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+        self.topic.subscribers.add(self.user)
+        topics = Topic.objects.filter(pk__in=[self.topic.pk, topic_2.pk]).order_by('pk')
+        with self.assertNumQueries(2):
+            topics = pybb_topic_subscribed(topics, self.user)
+        self.assertEqual([topic.subscribed for topic in topics], [True, False])
+
+    def test_mark_topic_read_forum_mark(self):
+        from pybb.read_tracking import get_read_tracking
+        topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+        Post.objects.create(topic=topic_2, user=self.user, body='two')
+        user = User.objects.create_user('reader', 'reader@localhost', 'reader')
+        # One of several unread topics is readed
+        get_read_tracking().mark_topic_read(Topic.objects.get(pk=self.topic.pk), user)
+        self.assertEqual(TopicReadTracker.objects.filter(user=user).count(), 1)
+        self.assertFalse(ForumReadTracker.objects.filter(user=user).exists())
+        # Last unread topic is readed
+        get_read_tracking().mark_topic_read(Topic.objects.get(pk=topic_2.pk), user)
+        self.assertEqual(TopicReadTracker.objects.filter(user=user).count(), 0)
+        self.assertEqual(ForumReadTracker.objects.filter(user=user, forum=self.forum).count(), 1)
+
+    def test_mark_forums_read_bulk(self):
+        from pybb.read_tracking import get_read_tracking
+        forum_2 = Forum.objects.create(name='xfoo2', description='bar', category=self.category)
+        user_2 = User.objects.create_user('user2', 'user2@localhost', 'user2')
+        ForumReadTracker.objects.create(forum=self.forum, user=self.user)
+        TopicReadTracker.objects.create(topic=self.topic, user=user_2)
+        get_read_tracking().mark_forums_read(Forum.objects.all(), [self.user, user_2])
+        self.assertEqual(ForumReadTracker.objects.filter(forum__in=[self.forum, forum_2]).count(), 4)
+        self.assertEqual(TopicReadTracker.objects.count(), 0)
+
+    def test_compact_read_tracking(self):
+        from pybb.templatetags.pybb_tags import pybb_topic_unread, pybb_forum_unread
+        defaults.PYBB_READ_TRACKING_BACKEND = 'pybb.read_tracking.CompactReadTracking'
+        try:
+            topic_2 = Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+            Post.objects.create(topic=topic_2, user=self.user, body='one')
+            self.login_client()
+            self.client.get(self.topic.get_absolute_url())
+            mark = CompactReadTracker.objects.get(user=self.user, forum=self.forum)
+            self.assertEqual(mark.time_stamp, None)
+            self.assertEqual(mark.get_topics().keys(), [self.topic.id])
+            topics = pybb_topic_unread(Topic.objects.filter(forum=self.forum).order_by('pk'), self.user)
+            self.assertEqual([topic.unread for topic in topics], [False, True])
+            self.assertTrue(pybb_forum_unread(Forum.objects.filter(pk=self.forum.pk), self.user)[0].unread)
+            # Readed topic is not marked again
+            from pybb.read_tracking import get_read_tracking
+            topic = Topic.objects.get(pk=self.topic.pk)
+            self.assertNumQueries(1, lambda: get_read_tracking().mark_topic_read(topic, self.user))
+            self.client.get(topic_2.get_absolute_url())
+            mark = CompactReadTracker.objects.get(user=self.user, forum=self.forum)
+            self.assertNotEqual(mark.time_stamp, None)
+            self.assertEqual(mark.topics, '')
+            self.assertFalse(pybb_forum_unread(Forum.objects.filter(pk=self.forum.pk), self.user)[0].unread)
+            self.assertEqual(TopicReadTracker.objects.count(), 0)
+        finally:
+            defaults.PYBB_READ_TRACKING_BACKEND = 'pybb.read_tracking.TrackerReadTracking'
+
     def test_latest_topics(self):
         topic_1 = self.topic
         topic_1.updated = datetime.datetime.utcnow()
@@ -592,6 +683,74 @@ class FeaturesTest(TestCase, SharedTestModule):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(user not in list(self.topic.subscribers.all()))
 
+    def test_digest_reply_through_view(self):
+        user = User.objects.create_user(username='user2', password='user2', email='user2@example.com')
+        profile = user.get_profile()
+        profile.digest = 'daily'
+        profile.save()
+        self.topic.subscribers.add(user)
+        self.login_client()
+        url = reverse('pybb:add_post', kwargs={'topic_id': self.topic.id})
+        values = self.get_form_values(self.client.get(url))
+        values['body'] = 'digest reply'
+        self.client.post(url, values, follow=True)
+        post = Post.objects.get(body='digest reply')
+        self.assertEqual(DigestItem.objects.filter(user=user, post=post).count(), 1)
+        # Edit does not add digest items
+        url = reverse('pybb:edit_post', kwargs={'pk': post.pk})
+        values = dict(html.fromstring(self.client.get(url).content).xpath('//form[@method="post"]')[0].form_values())
+        values['body'] = 'edited reply'
+        self.client.post(url, data=values)
+        self.assertEqual(DigestItem.objects.filter(user=user).count(), 1)
+
+    def test_notification_queue(self):
+        defaults.PYBB_NOTIFICATION_QUEUE = True
+        try:
+            user = User.objects.create_user(username='user2', password='user2', email='user2@example.com')
+            self.topic.subscribers.add(user)
+            new_post = Post(topic=self.topic, user=self.user, body='test queue')
+            new_post.save()
+            self.assertFalse([msg for msg in mail.outbox if new_post.get_absolute_url() in msg.body])
+            self.assertEqual(QueuedNotification.objects.filter(post=new_post).count(), 1)
+            call_command('pybb_send_notifications')
+            self.assertTrue([msg for msg in mail.outbox if new_post.get_absolute_url() in msg.body])
+            self.assertEqual(QueuedNotification.objects.count(), 0)
+        finally:
+            defaults.PYBB_NOTIFICATION_QUEUE = False
+
+    def test_digest(self):
+        user = User.objects.create_user(username='user2', password='user2', email='user2@example.com')
+        profile = user.get_profile()
+        profile.digest = 'hourly'
+        profile.save()
+        self.topic.subscribers.add(user)
+        mail.outbox = []
+        Post(topic=self.topic, user=self.user, body='first reply').save()
+        Post(topic=self.topic, user=self.user, body='second reply').save()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(user.digest_items.count(), 2)
+        call_command('pybb_send_digests', 'daily')
+        self.assertEqual(len(mail.outbox), 0)
+        call_command('pybb_send_digests', 'hourly')
+        self.assertEqual([msg.to for msg in mail.outbox], [['user2@example.com']])
+        self.assertTrue(self.topic.name in mail.outbox[0].body)
+        self.assertEqual(user.digest_items.count(), 0)
+
+    def test_digest_order(self):
+        user = User.objects.create_user(username='user2', password='user2', email='user2@example.com')
+        profile = user.get_profile()
+        profile.digest = 'hourly'
+        profile.save()
+        self.topic.subscribers.add(user)
+        mail.outbox = []
+        first = Post.objects.create(topic=self.topic, user=self.user, body='first reply')
+        second = Post.objects.create(topic=self.topic, user=self.user, body='second reply')
+        # Queued later, but created earlier
+        Post.objects.filter(pk=second.pk).update(created=first.created - datetime.timedelta(minutes=1))
+        call_command('pybb_send_digests', 'hourly')
+        self.assertTrue(second.get_absolute_url() in mail.outbox[0].body)
+        self.assertFalse(first.get_absolute_url() in mail.outbox[0].body)
+
     def test_topic_updated(self):
         topic = Topic(name='etopic', forum=self.forum, user=self.user)
         topic.save()
@@ -612,6 +771,280 @@ class FeaturesTest(TestCase, SharedTestModule):
         resp = self.client.get(reverse('pybb:user', kwargs={'username': self.user.username}))
         self.assertEqual(resp.status_code, 200)
 
+    def test_smile_it(self):
+        def image(name):
+            return '<img src="%s%s%s" alt="smile" />' % (settings.STATIC_URL, defaults.PYBB_SMILES_PREFIX, name)
+        self.assertEqual(defaults.smile_it('hi :) &gt;_&lt; :.( :('),
+                         'hi %s %s %s %s' % (image('smile.png'), image('angry.png'), image('cry.png'), image('sad.png')))
+
+    def test_render_cache(self):
+        calls = []
+        def engine(text):
+            calls.append(text)
+            return '<p>%s</p>' % text
+        old_engines = defaults.PYBB_MARKUP_ENGINES
+        defaults.PYBB_MARKUP_ENGINES = dict(old_engines, **{defaults.PYBB_MARKUP: engine})
+        defaults.PYBB_RENDER_CACHE = 'default'
+        try:
+            post = Post(topic=self.topic, user=self.user, body='cached body')
+            post.save()
+            post.save()
+            self.login_client()
+            response = self.client.post(reverse('pybb:post_ajax_preview'), data={'data': 'cached body'})
+            self.assertContains(response, '<p>cached body</p>')
+            self.assertEqual(calls, ['cached body'])
+            self.assertEqual(post.body_html, '<p>cached body</p>')
+        finally:
+            defaults.PYBB_MARKUP_ENGINES = old_engines
+            defaults.PYBB_RENDER_CACHE = None
+
+    def test_rerender(self):
+        Post.objects.filter(pk=self.post.pk).update(body_html='stale', body_text='stale')
+        call_command('pybb_rerender', 'posts', start_id=self.post.pk)
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual(post.body_html, defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](post.body))
+        self.assertNotEqual(post.body_text, 'stale')
+        # Render cache is refreshed, fragment versions are bumped and topic pages are purged
+        from django.core.cache import cache
+        from pybb.fragment_cache import get_fragment_cache, get_versions, version_key
+        from pybb.page_cache import get_purge_backend
+        from pybb.util import render_markup
+        defaults.PYBB_RENDER_CACHE = defaults.PYBB_FRAGMENT_CACHE = 'default'
+        defaults.PYBB_PURGE_BACKEND = 'pybb.page_cache.LocalPurgeBackend'
+        try:
+            cache.clear()
+            key = version_key(Post, self.post.pk)
+            version = get_versions(get_fragment_cache(), [key])[0]
+            old_engines = defaults.PYBB_MARKUP_ENGINES
+            Post.objects.filter(pk=self.post.pk).update(body_html='stale')
+            defaults.PYBB_MARKUP_ENGINES = dict(old_engines, **{defaults.PYBB_MARKUP: lambda text: 'new engine'})
+            del get_purge_backend().purged[:]
+            try:
+                call_command('pybb_rerender', 'posts', start_id=self.post.pk)
+                self.assertEqual(render_markup(self.post.body), 'new engine')
+            finally:
+                defaults.PYBB_MARKUP_ENGINES = old_engines
+            self.assertEqual(Post.objects.get(pk=self.post.pk).body_html, 'new engine')
+            self.assertNotEqual(get_versions(get_fragment_cache(), [key])[0], version)
+            self.assertTrue('pybb-topic-%d' % self.topic.pk in get_purge_backend().purged)
+        finally:
+            defaults.PYBB_RENDER_CACHE = defaults.PYBB_FRAGMENT_CACHE = None
+            defaults.PYBB_PURGE_BACKEND = None
+        # call_command of Django 1.4 exits on CommandError, so handle() is called directly
+        from pybb.management.commands.pybb_rerender import Command
+        self.assertRaises(CommandError, Command().handle, start_id=self.post.pk, processes=1, chunk_size=500)
+
+    def test_moderated_forums_cache(self):
+        from pybb.templatetags.pybb_tags import pybb_topic_moderated_by
+        defaults.PYBB_PERMISSION_CACHE = 'default'
+        try:
+            user = User.objects.create_user('moderator', 'moderator@localhost', 'moderator')
+            self.assertFalse(pybb_topic_moderated_by(self.topic, User.objects.get(pk=user.pk)))
+            self.forum.moderators.add(user)
+            user = User.objects.get(pk=user.pk)
+            self.assertTrue(pybb_topic_moderated_by(self.topic, user))
+            self.assertNumQueries(0, lambda: pybb_topic_moderated_by(self.topic, user))
+            user.forum_set.clear()
+            self.assertFalse(pybb_topic_moderated_by(self.topic, User.objects.get(pk=user.pk)))
+        finally:
+            defaults.PYBB_PERMISSION_CACHE = None
+
+    def test_post_page_visibility(self):
+        user_2 = User.objects.create_user('user2', 'user2@localhost', 'user2')
+        for i in range(defaults.PYBB_TOPIC_PAGE_SIZE):
+            Post.objects.create(topic=self.topic, user=user_2, body='moderated', on_moderation=True)
+        post = Post.objects.create(topic=self.topic, user=self.user, body='visible')
+        response = self.client.get(reverse('pybb:post', args=[post.id]))
+        self.assertTrue('?page=1#post-%d' % post.id in response['Location'])
+
+    def test_keyset_pagination(self):
+        defaults.PYBB_KEYSET_PAGINATION = True
+        try:
+            for i in range(defaults.PYBB_TOPIC_PAGE_SIZE + 5):
+                Post.objects.create(topic=self.topic, user=self.user, body='post %d' % i)
+            posts = list(self.topic.posts.order_by('created', 'id'))
+            response = self.client.get(self.topic.get_absolute_url())
+            querystring = response.context['page_obj'].next_page_number().querystring
+            self.assertTrue('after=' in querystring)
+            response = self.client.get('%s?%s' % (self.topic.get_absolute_url(), querystring))
+            self.assertEqual(list(response.context['page_obj'].object_list), posts[defaults.PYBB_TOPIC_PAGE_SIZE:])
+            querystring = response.context['page_obj'].previous_page_number().querystring
+            self.assertTrue('before=' in querystring)
+            response = self.client.get('%s?%s' % (self.topic.get_absolute_url(), querystring))
+            self.assertEqual(list(response.context['page_obj'].object_list), posts[:defaults.PYBB_TOPIC_PAGE_SIZE])
+            response = self.client.get('%s?page=2' % self.topic.get_absolute_url())
+            self.assertEqual(list(response.context['page_obj'].object_list), posts[defaults.PYBB_TOPIC_PAGE_SIZE:])
+        finally:
+            defaults.PYBB_KEYSET_PAGINATION = False
+
+    def test_pagination_count(self):
+        # Stored counter is used instead of COUNT(*)
+        Topic.objects.filter(pk=self.topic.pk).update(post_count=5)
+        self.assertEqual(self.client.get(self.topic.get_absolute_url()).context['paginator'].count, 5)
+        defaults.PYBB_PAGINATION_COUNT_CACHE = 'default'
+        try:
+            self.client.get(reverse('pybb:topic_latest'))
+            Topic.objects.create(name='topic_2', forum=self.forum, user=self.user)
+            response = self.client.get(reverse('pybb:topic_latest'))
+            # Count is cached for PYBB_PAGINATION_COUNT_TIMEOUT
+            self.assertEqual(response.context['paginator'].count, 1)
+        finally:
+            defaults.PYBB_PAGINATION_COUNT_CACHE = None
+
+    def test_update_counters_fields(self):
+        self.topic.name = 'not saved'
+        self.topic.update_counters()
+        topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertEqual(topic.name, 'etopic')
+        self.assertEqual(topic.post_count, 1)
+
+    def test_edit_post_counters(self):
+        self.login_client()
+        post = Post.objects.create(topic=self.topic, user=self.user, body='reply')
+        for edited in (self.post, post):
+            url = reverse('pybb:edit_post', kwargs={'pk': edited.pk})
+            values = dict(html.fromstring(self.client.get(url).content).xpath('//form[@method="post"]')[0].form_values())
+            values['body'] = 'edited'
+            self.client.post(url, data=values)
+        topic = Topic.objects.get(pk=self.topic.pk)
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(topic.post_count, 2)
+        self.assertEqual(topic.last_post_id, post.pk)
+        # Edit form keeps post.updated, the last post sets update time as update_counters does
+        self.assertEqual(post.updated, None)
+        self.assertEqual(topic.updated, post.created)
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual(forum.post_count, 2)
+        self.assertEqual(forum.updated, post.created)
+
+    def test_move_post_counters(self):
+        forum = Forum.objects.create(name='other', category=self.category)
+        topic = Topic.objects.create(name='other', forum=forum, user=self.user)
+        head = Post.objects.create(topic=topic, user=self.user, body='head')
+        post = Post.objects.create(topic=self.topic, user=self.user, body='moved')
+        post.topic = topic
+        post.save()
+        self.topic = Topic.objects.get(pk=self.topic.pk)
+        self.assertEqual((self.topic.post_count, self.topic.last_post_id), (1, self.post.pk))
+        topic = Topic.objects.get(pk=topic.pk)
+        self.assertEqual((topic.post_count, topic.head_post_id, topic.last_post_id), (2, head.pk, post.pk))
+        self.assertEqual(Forum.objects.get(pk=self.forum.pk).post_count, 1)
+        forum = Forum.objects.get(pk=forum.pk)
+        self.assertEqual((forum.post_count, forum.last_post_id), (2, post.pk))
+
+    def test_buffered_views(self):
+        self.client.get(self.topic.get_absolute_url())
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 1)
+        defaults.PYBB_VIEWS_BUFFER = 'cache'
+        try:
+            self.client.get(self.topic.get_absolute_url())
+            self.client.get(self.topic.get_absolute_url())
+            self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 1)
+            call_command('pybb_flush_views')
+            self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 3)
+            call_command('pybb_flush_views')
+            self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 3)
+            # Counter left at zero is registered again by next view
+            self.client.get(self.topic.get_absolute_url())
+            call_command('pybb_flush_views')
+            self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 4)
+        finally:
+            defaults.PYBB_VIEWS_BUFFER = None
+
+    def test_topic_page_prefetch(self):
+        user_2 = User.objects.create_user('user2', 'user2@localhost', 'user2')
+        Post.objects.create(topic=self.topic, user=user_2, body='two')
+        response = self.client.get(self.topic.get_absolute_url())
+        posts = response.context['post_list']
+        self.assertEqual(len(posts), 2)
+        for post in posts:
+            # Profiles and attachments are loaded for the whole page
+            self.assertNumQueries(0, lambda: post.user.get_profile())
+            self.assertNumQueries(0, lambda: list(post.attachments.all()))
+
+    def test_fragment_cache(self):
+        defaults.PYBB_FRAGMENT_CACHE = 'default'
+        try:
+            self.client.get(self.topic.get_absolute_url())
+            # Changes without signals are not visible until fragment expires
+            Post.objects.filter(pk=self.post.pk).update(body_html='<p>not saved</p>')
+            self.assertNotContains(self.client.get(self.topic.get_absolute_url()), 'not saved')
+            self.post.body = 'saved body'
+            self.post.save()
+            response = self.client.get(self.topic.get_absolute_url())
+            self.assertContains(response, 'saved body')
+            self.client.get(self.forum.get_absolute_url())
+            Topic.objects.filter(pk=self.topic.pk).update(name='not saved')
+            self.assertNotContains(self.client.get(self.forum.get_absolute_url()), 'not saved')
+            # Saved post refreshes row of its topic
+            Post.objects.create(topic=self.topic, user=self.user, body='two')
+            self.assertContains(self.client.get(self.forum.get_absolute_url()), 'not saved')
+            # Counters shifted with UPDATE refresh fragments too
+            from pybb.view_counter import count_view
+            Topic.objects.filter(pk=self.topic.pk).update(name='viewed')
+            count_view(self.topic.pk)
+            self.assertContains(self.client.get(self.forum.get_absolute_url()), 'viewed')
+            self.client.get(self.topic.get_absolute_url())
+            Post.objects.filter(pk=self.post.pk).update(body_html='<p>new post count</p>')
+            other = Topic.objects.create(name='other', forum=self.forum, user=self.user)
+            Post.objects.create(topic=other, user=self.user, body='other')
+            self.assertContains(self.client.get(self.topic.get_absolute_url()), 'new post count')
+            # Logged in users get uncached fragments
+            self.login_client()
+            Topic.objects.filter(pk=self.topic.pk).update(name='for user')
+            self.assertContains(self.client.get(self.forum.get_absolute_url()), 'for user')
+        finally:
+            defaults.PYBB_FRAGMENT_CACHE = None
+
+    def test_page_cache(self):
+        from pybb.page_cache import get_purge_backend
+        defaults.PYBB_PAGE_CACHE = 'default'
+        defaults.PYBB_PURGE_BACKEND = 'pybb.page_cache.LocalPurgeBackend'
+        url = self.topic.get_absolute_url()
+        try:
+            response = self.client.get(url)
+            self.assertEqual(response['Surrogate-Key'], 'pybb-topic-%d pybb-forum-topics-%d' % (self.topic.pk, self.forum.pk))
+            Post.objects.filter(pk=self.post.pk).update(body_html='<p>not saved</p>')
+            response = self.client.get(url)
+            self.assertNotContains(response, 'not saved')
+            self.assertEqual(response['Surrogate-Key'], 'pybb-topic-%d pybb-forum-topics-%d' % (self.topic.pk, self.forum.pk))
+            # Views of cached page are counted
+            self.assertEqual(Topic.objects.get(pk=self.topic.pk).views, 2)
+            Post.objects.create(topic=self.topic, user=self.user, body='new post')
+            self.assertContains(self.client.get(url), 'new post')
+            purged = get_purge_backend().purged
+            for key in ('pybb-topic-%d' % self.topic.pk, 'pybb-forum-%d' % self.forum.pk, 'pybb-index'):
+                self.assertTrue(key in purged)
+            # Cached page is not served to anonymous user with pending messages
+            from django.contrib.messages import constants
+            from django.contrib.messages.storage.base import Message
+            from django.contrib.messages.storage.cookie import CookieStorage
+            self.assertEqual(self.client.get(url).context, None)
+            self.client.cookies[CookieStorage.cookie_name] = CookieStorage(None)._encode([Message(constants.INFO, 'hi')])
+            self.assertNotEqual(self.client.get(url).context, None)
+            # Hiding forum or category purges pages of its topics
+            del purged[:]
+            self.forum.hidden = True
+            self.forum.save()
+            self.assertTrue('pybb-forum-topics-%d' % self.forum.pk in purged)
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.forum.hidden = False
+            self.forum.save()
+            del purged[:]
+            self.category.hidden = True
+            self.category.save()
+            self.assertTrue('pybb-forum-topics-%d' % self.forum.pk in purged)
+            self.category.hidden = False
+            self.category.save()
+            # Pages of logged in users are not cached
+            self.login_client()
+            self.client.get(url)
+            Post.objects.filter(pk=self.post.pk).update(body_html='<p>for user</p>')
+            self.assertContains(self.client.get(url), 'for user')
+        finally:
+            defaults.PYBB_PAGE_CACHE = None
+            defaults.PYBB_PURGE_BACKEND = None
+
     def test_post_count(self):
         topic = Topic(name='etopic', forum=self.forum, user=self.user)
         topic.save()
@@ -624,6 +1057,43 @@ class FeaturesTest(TestCase, SharedTestModule):
         post.delete()
         self.assertEqual(Profile.objects.get(pk=self.user.get_profile().pk).post_count, 1)
 
+    def test_last_post_pointers(self):
+        topic = Topic(name='xtopic', forum=self.forum, user=self.user)
+        topic.save()
+        head = Post(topic=topic, user=self.user, body='one')
+        head.save()
+        post = Post(topic=topic, user=self.user, body='two')
+        post.save()
+        topic = Topic.objects.get(id=topic.id)
+        self.assertEqual(topic.head, head)
+        self.assertEqual(topic.last_post, post)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).last_post, post)
+        post.delete()
+        topic = Topic.objects.get(id=topic.id)
+        self.assertEqual(topic.last_post, head)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).last_post, head)
+        head.delete()
+        self.assertEqual(Forum.objects.get(id=self.forum.id).last_post, self.post)
+
+    def test_delta_counters(self):
+        topic = Topic(name='xtopic', forum=self.forum, user=self.user)
+        topic.save()
+        Post(topic=topic, user=self.user, body='one').save()
+        post = Post(topic=topic, user=self.user, body='two')
+        post.save()
+        self.assertEqual(Topic.objects.get(id=topic.id).post_count, 2)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).post_count, 3)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).topic_count, 2)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).updated, post.created)
+        post.delete()
+        self.assertEqual(Topic.objects.get(id=topic.id).post_count, 1)
+        self.assertEqual(Forum.objects.get(id=self.forum.id).post_count, 2)
+        topic.delete()
+        forum = Forum.objects.get(id=self.forum.id)
+        self.assertEqual((forum.topic_count, forum.post_count), (1, 1))
+        forum.update_counters()
+        self.assertEqual((forum.topic_count, forum.post_count), (1, 1))
+
     def tearDown(self):
         defaults.PYBB_ENABLE_ANONYMOUS_POST = self.ORIG_PYBB_ENABLE_ANONYMOUS_POST
         defaults.PYBB_PREMODERATION = self.ORIG_PYBB_PREMODERATION
@@ -999,4 +1469,92 @@ class FiltersTest(TestCase, SharedTestModule):
         values['body'] = u'test\n \n \n\nmultiple empty lines\n'
         response = self.client.post(add_post_url, values, follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(Post.objects.all()[0].body, u'test\nmultiple empty lines')
\ No newline at end of file
+        self.assertEqual(Post.objects.all()[0].body, u'test\nmultiple empty lines')
+
+class WatchAreaTest(TestCase, SharedTestModule):
+    def setUp(self):
+        self.create_user()
+        self.category = Category.objects.create(name='foo')
+        self.forum = Forum.objects.create(name='xfoo', description='bar', category=self.category)
+        self.inside = Topic.objects.create(name='inside', forum=self.forum, user=self.user,
+                                           place='POINT(5 5)')
+        self.outside = Topic.objects.create(name='outside', forum=self.forum, user=self.user,
+                                            place='POINT(50 50)')
+        self.watch_area = WatchArea.objects.create(name='area', user=self.user, public=True,
+                                                   fence='POLYGON((0 0, 0 10, 10 10, 10 0, 0 0))')
+
+    def test_index_watch_area_stats(self):
+        response = self.client.get(reverse('pybb:index'))
+        watch_areas = list(response.context['watch_areas'])
+        self.assertEqual(len(watch_areas), 1)
+        self.assertEqual(watch_areas[0].topic_count, 1)
+        self.assertEqual(watch_areas[0].latest_update, self.inside.created)
+        # Watchers do not multiply topic stats
+        for name in ('watcher1', 'watcher2'):
+            self.watch_area.watchers.add(User.objects.create_user(name, '%s@example.com' % name, name))
+        Topic.objects.create(name='inside2', forum=self.forum, user=self.user, place='POINT(3 3)')
+        watch_areas = list(self.client.get(reverse('pybb:index')).context['watch_areas'])
+        self.assertEqual((watch_areas[0].topic_count, watch_areas[0].watcher_count), (2, 2))
+
+    def test_watch_area_membership(self):
+        self.assertEqual(list(self.watch_area.topics.all()), [self.inside])
+        self.outside.place = 'POINT(6 6)'
+        self.outside.save()
+        self.assertEqual(set(self.watch_area.topics.all()), set([self.inside, self.outside]))
+        self.watch_area.fence = 'POLYGON((40 40, 40 60, 60 60, 60 40, 40 40))'
+        self.watch_area.save()
+        self.assertEqual(list(self.watch_area.topics.all()), [])
+        response = self.client.get(self.watch_area.get_absolute_url())
+        self.assertEqual(len(response.context['topic_list']), 0)
+
+    def test_watch_area_page_purge(self):
+        from pybb.page_cache import get_purge_backend
+        defaults.PYBB_PURGE_BACKEND = 'pybb.page_cache.LocalPurgeBackend'
+        area_key = 'pybb-area-%d' % self.watch_area.pk
+        try:
+            purged = get_purge_backend().purged
+            # Area which topic left is purged
+            del purged[:]
+            self.inside.place = 'POINT(50 50)'
+            self.inside.save()
+            self.assertTrue(area_key in purged)
+            # Area of deleted topic is purged
+            self.inside.place = 'POINT(5 5)'
+            self.inside.save()
+            del purged[:]
+            self.inside.delete()
+            self.assertTrue(area_key in purged)
+        finally:
+            defaults.PYBB_PURGE_BACKEND = None
+
+    def test_watch_area_membership_rebuild(self):
+        # Saves which keep place or fence do not rebuild membership
+        WatchAreaTopic.objects.all().delete()
+        topic = Topic.objects.get(pk=self.inside.pk)
+        topic.name = 'renamed'
+        topic.save()
+        watch_area = WatchArea.objects.get(pk=self.watch_area.pk)
+        watch_area.name = 'renamed'
+        watch_area.save()
+        self.assertEqual(WatchAreaTopic.objects.count(), 0)
+        topic.place = 'POINT(6 6)'
+        topic.save()
+        self.assertEqual(list(self.watch_area.topics.all()), [self.inside])
+        watch_area.fence = 'POLYGON((0 0, 0 60, 60 60, 60 0, 0 0))'
+        watch_area.save()
+        self.assertEqual(set(self.watch_area.topics.all()), set([self.inside, self.outside]))
+
+    def test_watch_area_notifications(self):
+        defaults.PYBB_NOTIFICATION_QUEUE = True
+        try:
+            mail.outbox = []
+            watcher = User.objects.create_user(username='watcher', password='watcher', email='watcher@example.com')
+            self.watch_area.watchers.add(watcher)
+            topic = Topic.objects.create(name='new', forum=self.forum, user=self.user, place='POINT(1 1)')
+            self.assertEqual(len(mail.outbox), 0)
+            self.assertEqual(QueuedNotification.objects.filter(topic=topic).count(), 1)
+            call_command('pybb_send_notifications')
+            self.assertEqual([msg.to for msg in mail.outbox], [['watcher@example.com']])
+            self.assertEqual(QueuedNotification.objects.count(), 0)
+        finally:
+            defaults.PYBB_NOTIFICATION_QUEUE = False
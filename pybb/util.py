@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import re
+from hashlib import sha1
+
+from django.conf import settings
+
+try:
+    from django.utils import timezone
+except ImportError:
+    timezone = None
 
 def unescape(text):
     """
@@ -24,4 +33,114 @@ def rstrip_str(user, str):
     """
     if user.is_staff:
         return str
-    return '\n'.join([s.rstrip() for s in str.splitlines()])
\ No newline at end of file
+    return '\n'.join([s.rstrip() for s in str.splitlines()])
+
+def update_fields(instance, *fields):
+    """
+    Write only given fields of saved model instance with single UPDATE query.
+    Other columns are not rewritten and no signals are sent.
+    """
+    instance.__class__._default_manager.filter(pk=instance.pk)\
+                                       .update(**dict((name, getattr(instance, name)) for name in fields))
+
+def get_profile_model():
+    """
+    Return model class configured as AUTH_PROFILE_MODULE
+    """
+    from django.db.models import get_model
+    app_label, model_name = settings.AUTH_PROFILE_MODULE.split('.')
+    return get_model(app_label, model_name)
+
+def prefetch_profiles(users):
+    """
+    Load profiles of all given users with one query and cache them
+    on user objects, so user.get_profile() does not query database.
+    """
+    users = [user for user in users if user.pk and not hasattr(user, '_profile_cache')]
+    if not users:
+        return
+    profiles = get_profile_model().objects.filter(user__in=set(user.pk for user in users))
+    profiles = dict((profile.user_id, profile) for profile in profiles)
+    for user in users:
+        if user.pk in profiles:
+            user._profile_cache = profiles[user.pk]
+
+_smiles_hash = None
+
+def render_markup(text, refresh=False):
+    """
+    Render text with the configured markup engine.
+    If PYBB_RENDER_CACHE is set, rendered html is stored in that cache keyed by
+    markup engine, PYBB_RENDER_CACHE_VERSION, smiles set and hash of text.
+    With ``refresh`` text is rendered again and replaces html stored in cache.
+    """
+    from pybb import defaults
+
+    engine = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP]
+    if not defaults.PYBB_RENDER_CACHE:
+        return engine(text)
+
+    global _smiles_hash
+    if _smiles_hash is None:
+        smiles = sorted(defaults.PYBB_SMILES.items()) + [settings.STATIC_URL, defaults.PYBB_SMILES_PREFIX]
+        _smiles_hash = sha1(repr(smiles)).hexdigest()[:8]
+
+    from django.core.cache import get_cache
+    cache = get_cache(defaults.PYBB_RENDER_CACHE)
+    key = 'pybb_render:%s:%s:%s:%s' % (defaults.PYBB_MARKUP, defaults.PYBB_RENDER_CACHE_VERSION, _smiles_hash,
+                                       sha1(text.encode('utf-8')).hexdigest())
+    html = None if refresh else cache.get(key)
+    if html is None:
+        html = engine(text)
+        cache.set(key, html)
+    return html
+
+def get_moderated_forum_ids(user):
+    """
+    Return set of ids of forums moderated by user.
+    Set is cached on the user object, so it is loaded once per request, and if
+    PYBB_PERMISSION_CACHE is set, in that cache until moderators of any forum are changed.
+    """
+    if not user.is_authenticated():
+        return frozenset()
+    forum_ids = getattr(user, '_pybb_moderated_forum_ids', None)
+    if forum_ids is not None:
+        return forum_ids
+
+    from pybb import defaults
+    from pybb.models import Forum
+
+    cache = None
+    if defaults.PYBB_PERMISSION_CACHE:
+        from django.core.cache import get_cache
+        cache = get_cache(defaults.PYBB_PERMISSION_CACHE)
+        forum_ids = cache.get(moderated_forums_cache_key(user.pk))
+    if forum_ids is None:
+        forum_ids = frozenset(Forum.moderators.through.objects.filter(user=user).values_list('forum_id', flat=True))
+        if cache is not None:
+            cache.set(moderated_forums_cache_key(user.pk), forum_ids)
+    user._pybb_moderated_forum_ids = forum_ids
+    return forum_ids
+
+def moderated_forums_cache_key(user_id):
+    return 'pybb_moderated_forums:%s' % user_id
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_microseconds(value):
+    """
+    Convert datetime to number of microseconds since epoch
+    """
+    if timezone is not None and timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def from_microseconds(value):
+    """
+    Convert number of microseconds since epoch to datetime, aware if USE_TZ is on
+    """
+    value = _EPOCH + datetime.timedelta(microseconds=value)
+    if timezone is not None and getattr(settings, 'USE_TZ', False):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+Topic view counter. With PYBB_VIEWS_BUFFER setting views are collected in memory of
+process or in cache and written to database periodically with batched updates.
+Every topic with buffered views in cache is registered in numbered slot, so flush
+can find them without scanning all topics.
+"""
+
+import threading
+import time
+
+from django.db.models import F
+
+from pybb import defaults
+from pybb.fragment_cache import bump_versions
+from pybb.models import Topic
+
+COUNTER_KEY = 'pybb_topic_views:%s'
+SLOT_KEY = 'pybb_topic_views_slot:%s'
+SLOTS_KEY = 'pybb_topic_views_slots'
+FLUSHED_KEY = 'pybb_topic_views_flushed'
+REGISTER_INTERVAL = 100
+
+_lock = threading.Lock()
+_pending = {}
+_last_flush = time.time()
+
+
+def add_view(topic):
+    """
+    Count one view of topic
+    """
+    topic.views += 1
+    count_view(topic.pk)
+
+
+def count_view(topic_id):
+    """
+    Count one view of topic with given id, without loading it
+    """
+    if defaults.PYBB_VIEWS_BUFFER == 'memory':
+        with _lock:
+            _pending[topic_id] = _pending.get(topic_id, 0) + 1
+    elif defaults.PYBB_VIEWS_BUFFER == 'cache':
+        cache = get_views_cache()
+        key = COUNTER_KEY % topic_id
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            if cache.add(key, 1):
+                count = 1
+            else:
+                count = cache.incr(key)
+        # Topic is registered for flush when its counter starts from zero, and again
+        # once in a while, in case its slot was evicted from cache
+        if count == 1 or count % REGISTER_INTERVAL == 0:
+            register_topic(cache, topic_id)
+    else:
+        Topic.objects.filter(pk=topic_id).update(views=F('views') + 1)
+        bump_versions((Topic, topic_id))
+
+
+def register_topic(cache, topic_id):
+    cache.add(SLOTS_KEY, 0)
+    cache.set(SLOT_KEY % cache.incr(SLOTS_KEY), topic_id)
+
+
+def get_views_cache():
+    from django.core.cache import get_cache
+    return get_cache(defaults.PYBB_VIEWS_BUFFER_CACHE)
+
+
+def save_views(views):
+    """
+    Add views to topics, with one UPDATE for every distinct number of views.
+    `views` is dict topic id -> number of views. UPDATE sends no signals, so
+    fragment versions of topics are bumped here.
+    """
+    topics = {}
+    for topic_id, count in views.iteritems():
+        if count:
+            topics.setdefault(count, []).append(topic_id)
+    for count, topic_ids in topics.iteritems():
+        Topic.objects.filter(pk__in=topic_ids).update(views=F('views') + count)
+        bump_versions(*[(Topic, topic_id) for topic_id in topic_ids])
+
+
+def flush_memory():
+    """
+    Write views collected in memory of this process to database
+    """
+    global _pending, _last_flush
+    with _lock:
+        views, _pending = _pending, {}
+        _last_flush = time.time()
+    save_views(views)
+    return len(views)
+
+
+def flush_memory_if_needed():
+    """
+    Write views collected in memory, if PYBB_VIEWS_FLUSH_INTERVAL is passed since last flush
+    """
+    if _pending and time.time() - _last_flush >= defaults.PYBB_VIEWS_FLUSH_INTERVAL:
+        flush_memory()
+
+
+def flush_cache():
+    """
+    Write views collected in cache to database
+    """
+    cache = get_views_cache()
+    last_slot = cache.get(SLOTS_KEY, 0)
+    first_slot = cache.get(FLUSHED_KEY, 0) + 1
+    slot_keys = [SLOT_KEY % slot for slot in range(first_slot, last_slot + 1)]
+    topic_ids = set(cache.get_many(slot_keys).values())
+    counts = cache.get_many([COUNTER_KEY % topic_id for topic_id in topic_ids])
+    views = {}
+    for topic_id in topic_ids:
+        key = COUNTER_KEY % topic_id
+        count = counts.get(key)
+        if not count:
+            continue
+        # decr keeps views added since counter was read. Counter is not deleted when it's
+        # zero, because view could be added just after decr, it's left to expire.
+        try:
+            if cache.decr(key, count):
+                register_topic(cache, topic_id)
+        except ValueError:
+            # Counter was evicted
+            pass
+        views[topic_id] = count
+    cache.set(FLUSHED_KEY, last_slot)
+    cache.delete_many(slot_keys)
+    save_views(views)
+    return len(views)
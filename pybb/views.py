@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import math
+from hashlib import sha1
 
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required, permission_required
@@ -29,15 +30,32 @@ except ImportError:
 
 from pure_pagination import Paginator
 
-from pybb.models import Category, Forum, Topic, Post, TopicReadTracker, \
-    ForumReadTracker, PollAnswerUser, WatchArea
+from pybb.models import Category, Forum, Topic, Post, PollAnswerUser, WatchArea
 from pybb.forms import  PostForm, AdminPostForm, EditProfileForm, \
     AttachmentFormSet, PollAnswerFormSet, PollForm, WatchAreaForm
 from pybb.templatetags.pybb_tags import pybb_editable_by, pybb_topic_poll_not_voted
 from pybb.templatetags.pybb_tags import pybb_topic_moderated_by
 from pybb import defaults
+from pybb.util import render_markup, get_moderated_forum_ids, update_fields, prefetch_profiles
+from pybb.read_tracking import get_read_tracking
+from pybb.fragment_cache import bump_versions
+from pybb import page_cache
+from pybb.view_counter import add_view, count_view
+from pybb.paginator import CountPaginator, KeysetPaginator
+from pybb.middleware import PROFILE_LANGUAGE_KEY
 
 
+def filter_visible_posts(request, topic, queryset):
+    """
+    Return queryset of topic posts, filtering posts on moderation for users who can't see them.
+    """
+    if not pybb_topic_moderated_by(topic, request.user):
+        if request.user.is_authenticated():
+            queryset = queryset.filter(Q(user=request.user)|Q(on_moderation=False))
+        else:
+            queryset = queryset.filter(on_moderation=False)
+    return queryset
+
 def filter_hidden(request, queryset_or_model):
     """
     Return queryset for model, manager or queryset, filtering hidden objects for non staff users.
@@ -62,35 +80,74 @@ class WatchAreaListMixin (object):
         return WatchArea.objects.for_user(self.request.user)
 
 
-class IndexView(WatchAreaListMixin, generic.ListView):
+class PageCacheMixin(object):
+    """
+    Cache whole pages for anonymous users in PYBB_PAGE_CACHE and mark them with
+    Surrogate-Key header. Pages are purged by signals, see pybb.page_cache.
+    """
+
+    def get_surrogate_keys(self):
+        return []
+
+    def cached_response_served(self):
+        pass
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated() or not page_cache.is_enabled():
+            return super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+        # Pending messages must be shown by the page, not hidden behind cached one
+        storage = getattr(request, '_messages', None)
+        if storage is not None and len(storage):
+            return super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+        self.kwargs = kwargs
+        keys = self.get_surrogate_keys()
+        versions = page_cache.get_key_versions(keys)
+        response = page_cache.get_cached_response(request, versions)
+        if response is not None:
+            self.cached_response_served()
+            return response
+        # Track session access of the view only, session was already read for request.user
+        session = getattr(request, 'session', None)
+        if session is not None:
+            session_accessed, session.accessed = session.accessed, False
+        try:
+            response = super(PageCacheMixin, self).dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        finally:
+            if session is not None:
+                personal_session = session.accessed or session.modified
+                session.accessed = session.accessed or session_accessed
+        # Pages with CSRF token, cookies, session data or messages are not shared between users
+        if (response.status_code == 200 and not request.META.get('CSRF_COOKIE_USED') and not response.cookies
+                and not (session is not None and personal_session)
+                and not (storage is not None and storage.added_new)):
+            page_cache.cache_response(request, response, keys, versions)
+        return response
+
+
+class IndexView(PageCacheMixin, WatchAreaListMixin, generic.ListView):
 
     template_name = 'pybb/index.html'
     context_object_name = 'categories'
 
+    def get_surrogate_keys(self):
+        return [page_cache.INDEX_KEY]
+
     def get_context_data(self, **kwargs):
         ctx = super(IndexView, self).get_context_data(**kwargs)
         categories = list(ctx['categories'])
         for category in categories:
-            category.forums_accessed = filter_hidden(self.request, category.forums.all())
+            category.forums_accessed = filter_hidden(self.request, category.forums.all())\
+                .select_related('last_post', 'last_post__user')
         ctx['categories'] = categories
         ctx['site'] = Site.objects.get_current()
         ctx['absolute_static'] = self.request.build_absolute_uri(staticfiles_storage.base_url)
 
         # Calculate watch area summary stats
         watch_areas = self.get_watch_areas() \
-            .annotate(watcher_count=Count('watchers'))
-        all_topics = Topic.objects.all()
-        for watch_area in watch_areas:
-            watch_area.topics = []
-            for topic in all_topics:
-                if watch_area.fence.intersects(topic.place):
-                    watch_area.topics.append(topic)
-            watch_area.topic_count = len(watch_area.topics)
-            if watch_area.topic_count > 0:
-                watch_area.latest_update = max([
-                    topic.updated or topic.created
-                    for topic in watch_area.topics])
-        ctx['watch_areas'] = watch_areas
+            .annotate(watcher_count=Count('watchers', distinct=True))
+        ctx['watch_areas'] = WatchArea.objects.with_topic_stats(watch_areas)
 
         # Get a list of featured topics
         featured_topics = Topic.objects
@@ -119,12 +176,54 @@ class CategoryView(generic.DetailView):
         return ctx
 
 
-class ForumView(generic.ListView):
+class PaginationMixin(object):
+    """
+    Paginate without COUNT(*) query for every request: use stored counters where they are exact,
+    or count cached in PYBB_PAGINATION_COUNT_CACHE. Use KeysetPaginator with `keyset_ordering`
+    if PYBB_KEYSET_PAGINATION is enabled.
+    """
+    keyset_ordering = None
+
+    def get_paginator_count(self, queryset):
+        """
+        Return number of objects in queryset from cache, or None
+        """
+        if not defaults.PYBB_PAGINATION_COUNT_CACHE:
+            return None
+        from django.core.cache import get_cache
+        cache = get_cache(defaults.PYBB_PAGINATION_COUNT_CACHE)
+        # Query contains all visibility conditions, so it's used as a key
+        key = 'pybb_count:%s' % sha1(str(queryset.query)).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, defaults.PYBB_PAGINATION_COUNT_TIMEOUT)
+        return count
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        count = self.get_paginator_count(queryset)
+        if defaults.PYBB_KEYSET_PAGINATION and self.keyset_ordering:
+            return KeysetPaginator(queryset, per_page, self.keyset_ordering, request=self.request,
+                                   count=count, allow_empty_first_page=allow_empty_first_page)
+        return CountPaginator(queryset, per_page, count=count, orphans=orphans,
+                              allow_empty_first_page=allow_empty_first_page)
+
+
+class ForumView(PageCacheMixin, PaginationMixin, generic.ListView):
 
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
     context_object_name = 'topic_list'
     template_name = 'pybb/forum.html'
     paginator_class = Paginator
+    keyset_ordering = ['-sticky', '-updated', '-id']
+
+    def get_surrogate_keys(self):
+        return [page_cache.FORUM_KEY % self.kwargs['pk']]
+
+    def get_paginator_count(self, queryset):
+        if self.all_topics_visible:
+            return self.forum.topic_count
+        return super(ForumView, self).get_paginator_count(queryset)
 
     def get_context_data(self, **kwargs):
         ctx = super(ForumView, self).get_context_data(**kwargs)
@@ -135,8 +234,12 @@ class ForumView(generic.ListView):
         self.forum = get_object_or_404(filter_hidden(self.request, Forum), pk=self.kwargs['pk'])
         if self.forum.category.hidden and (not self.request.user.is_staff):
             raise Http404()
-        qs = self.forum.topics.order_by('-sticky', '-updated').select_related()
-        if not (self.request.user.is_superuser or self.request.user in self.forum.moderators.all()):
+        qs = self.forum.topics.order_by('-sticky', '-updated')\
+            .select_related('user', 'last_post', 'last_post__user')
+        self.all_topics_visible = not defaults.PYBB_PREMODERATION
+        if self.request.user.is_superuser or self.forum.pk in get_moderated_forum_ids(self.request.user):
+            self.all_topics_visible = True
+        else:
             if self.request.user.is_authenticated():
                 qs = qs.filter(Q(user=self.request.user)|Q(on_moderation=False))
             else:
@@ -144,15 +247,20 @@ class ForumView(generic.ListView):
         return qs
 
 
-class LatestTopicsView(generic.ListView):
+class LatestTopicsView(PageCacheMixin, PaginationMixin, generic.ListView):
 
     paginate_by = defaults.PYBB_FORUM_PAGE_SIZE
     context_object_name = 'topic_list'
     template_name = 'pybb/latest_topics.html'
     paginator_class = Paginator
+    keyset_ordering = ['-updated', '-id']
+
+    def get_surrogate_keys(self):
+        return [page_cache.LATEST_KEY]
 
     def get_queryset(self):
-        qs = Topic.objects.all().select_related()
+        qs = Topic.objects.all()\
+            .select_related('forum', 'forum__category', 'user', 'last_post', 'last_post__user')
         qs = filter_hidden_topics(self.request, qs)
         if not self.request.user.is_superuser:
             if self.request.user.is_authenticated():
@@ -171,10 +279,13 @@ class WatchAreaTopicsView(LatestTopicsView):
     def get_watch_area(self):
         return get_object_or_404(WatchArea, pk=self.kwargs['pk'])
 
+    def get_surrogate_keys(self):
+        return [page_cache.WATCH_AREA_KEY % self.kwargs['pk']]
+
     def get_queryset(self):
         qs = super(WatchAreaTopicsView, self).get_queryset()
         self.watch_area = self.get_watch_area()
-        qs = qs.filter(place__within=self.watch_area.fence)  # Should we use within or intersects?
+        qs = qs.filter(watch_areas=self.watch_area)
         return qs
 
     def user_can_access(self, user):
@@ -195,11 +306,27 @@ class WatchAreaTopicsView(LatestTopicsView):
         return ctx
 
 
-class TopicView(WatchAreaListMixin, generic.ListView):
+class TopicView(PageCacheMixin, WatchAreaListMixin, PaginationMixin, generic.ListView):
     paginate_by = defaults.PYBB_TOPIC_PAGE_SIZE
     template_object_name = 'post_list'
     template_name = 'pybb/topic.html'
     paginator_class = Paginator
+    keyset_ordering = ['created', 'id']
+
+    def get_surrogate_keys(self):
+        keys = [page_cache.TOPIC_KEY % self.kwargs['pk']]
+        # Changes of forum, e.g. hiding it or its category, purge pages of all its topics
+        forum_ids = Topic.objects.filter(pk=self.kwargs['pk']).values_list('forum_id', flat=True)
+        keys.extend(page_cache.FORUM_TOPICS_KEY % forum_id for forum_id in forum_ids)
+        return keys
+
+    def cached_response_served(self):
+        count_view(int(self.kwargs['pk']))
+
+    def get_paginator_count(self, queryset):
+        if not defaults.PYBB_PREMODERATION or pybb_topic_moderated_by(self.topic, self.request.user):
+            return self.topic.post_count
+        return super(TopicView, self).get_paginator_count(queryset)
 
     def get_queryset(self):
         self.topic = get_object_or_404(Topic.objects.select_related('forum'), pk=self.kwargs['pk'])
@@ -209,15 +336,9 @@ class TopicView(WatchAreaListMixin, generic.ListView):
             raise PermissionDenied
         if (self.topic.forum.hidden or self.topic.forum.category.hidden) and (not self.request.user.is_staff):
             raise Http404()
-        self.topic.views += 1
-        self.topic.save()
-        qs = self.topic.posts.all().select_related('user')
-        if not pybb_topic_moderated_by(self.topic, self.request.user):
-            if self.request.user.is_authenticated():
-                qs = qs.filter(Q(user=self.request.user)|Q(on_moderation=False))
-            else:
-                qs = qs.filter(on_moderation=False)
-        return qs
+        add_view(self.topic)
+        return filter_visible_posts(self.request, self.topic,
+                                    self.topic.posts.all().select_related('user').prefetch_related('attachments'))
 
     def get_context_data(self, **kwargs):
         ctx = super(TopicView, self).get_context_data(**kwargs)
@@ -226,8 +347,8 @@ class TopicView(WatchAreaListMixin, generic.ListView):
         ctx['absolute_static'] = self.request.build_absolute_uri(staticfiles_storage.base_url)
 
         if self.request.user.is_authenticated():
-            self.request.user.is_moderator = self.request.user.is_superuser or (self.request.user in self.topic.forum.moderators.all())
-            self.request.user.is_subscribed = self.request.user in self.topic.subscribers.all()
+            self.request.user.is_moderator = pybb_topic_moderated_by(self.topic, self.request.user)
+            self.request.user.is_subscribed = self.topic.subscribers.filter(pk=self.request.user.pk).exists()
             if self.request.user.is_staff:
                 ctx['form'] = AdminPostForm(initial={'login': self.request.user.username}, topic=self.topic)
             else:
@@ -246,8 +367,14 @@ class TopicView(WatchAreaListMixin, generic.ListView):
             ctx['first_post'] = None
         ctx['topic'] = self.topic
 
+        # Profiles of all authors on the page are loaded with one query
+        posts = list(ctx['object_list'])
+        if ctx['first_post']:
+            posts.append(ctx['first_post'])
+        prefetch_profiles([post.user for post in posts])
+
         ctx['watch_areas'] = self.get_watch_areas()\
-            .filter(fence__intersects=self.topic.place)
+            .filter(topics=self.topic)
 
         if self.request.user.is_authenticated() and self.topic.poll_type != Topic.POLL_TYPE_NONE and \
            pybb_topic_poll_not_voted(self.topic, self.request.user):
@@ -256,28 +383,7 @@ class TopicView(WatchAreaListMixin, generic.ListView):
         return ctx
 
     def mark_read(self, request, topic):
-        try:
-            forum_mark = ForumReadTracker.objects.get(forum=topic.forum, user=request.user)
-        except ObjectDoesNotExist:
-            forum_mark = None
-        if (forum_mark is None) or (topic.updated and forum_mark.time_stamp < topic.updated):
-            # Mark topic as readed
-            topic_mark, new = TopicReadTracker.objects.get_or_create(topic=topic, user=request.user)
-            if not new:
-                topic_mark.save()
-
-            # Check, if there are any unread topics in forum
-            read = Topic.objects.filter(Q(forum=topic.forum) & (Q(topicreadtracker__user=request.user,topicreadtracker__time_stamp__gt=F('updated'))) |
-                                                                Q(forum__forumreadtracker__user=request.user,forum__forumreadtracker__time_stamp__gt=F('updated')))
-            unread = Topic.objects.filter(forum=topic.forum).exclude(id__in=read)
-            if not unread.exists():
-                # Clear all topic marks for this forum, mark forum as readed
-                TopicReadTracker.objects.filter(
-                        user=request.user,
-                        topic__forum=topic.forum
-                        ).delete()
-                forum_mark, new = ForumReadTracker.objects.get_or_create(forum=topic.forum, user=request.user)
-                forum_mark.save()
+        get_read_tracking().mark_topic_read(topic, request.user)
 
 
 class PostEditMixin(object):
@@ -318,6 +424,7 @@ class PostEditMixin(object):
                     success = False
             else:
                 self.object.topic.poll_question = None
+                self.object.topic.refresh_counters()
                 self.object.topic.save()
                 self.object.topic.poll_answers.all().delete()
                 pollformset = PollAnswerFormSet()
@@ -494,13 +601,15 @@ class UserView(generic.DetailView):
 
 class PostView(generic.RedirectView):
     def get_redirect_url(self, **kwargs):
-        post = get_object_or_404(Post, pk=self.kwargs['pk'])
+        post = get_object_or_404(Post.objects.select_related('topic'), pk=self.kwargs['pk'])
         if defaults.PYBB_PREMODERATION and\
             post.on_moderation and\
             (not pybb_topic_moderated_by(post.topic, self.request.user)) and\
             (not post.user==self.request.user):
             raise PermissionDenied
-        count = post.topic.posts.filter(created__lt=post.created).count() + 1
+        # Count only posts shown on topic pages, (topic, created) index makes it a range scan
+        previous_posts = filter_visible_posts(self.request, post.topic, post.topic.posts.filter(created__lt=post.created))
+        count = previous_posts.count() + 1
         page = math.ceil(count / float(defaults.PYBB_TOPIC_PAGE_SIZE))
         return '%s?page=%d#post-%d' % (reverse('pybb:topic', args=[post.topic.id]), page, post.id)
 
@@ -528,6 +637,11 @@ class ProfileEditView(generic.UpdateView):
     def dispatch(self, request, *args, **kwargs):
         return super(ProfileEditView, self).dispatch(request, *args, **kwargs)
 
+    def form_valid(self, form):
+        # Language is synced with session again on next request
+        self.request.session.pop(PROFILE_LANGUAGE_KEY, None)
+        return super(ProfileEditView, self).form_valid(form)
+
     def get_success_url(self):
         return reverse('pybb:edit_profile')
 
@@ -578,31 +692,34 @@ class TopicActionBaseView(generic.View):
     def get(self, *args, **kwargs):
         self.topic = self.get_topic()
         self.action(self.topic)
+        # Actions write with update_fields, which sends no signals
+        bump_versions((Topic, self.topic.pk))
+        page_cache.purge_topic(self.topic)
         return HttpResponseRedirect(self.topic.get_absolute_url())
 
 
 class StickTopicView(TopicActionBaseView):
     def action(self, topic):
         topic.sticky = True
-        topic.save()
+        update_fields(topic, 'sticky')
 
 
 class UnstickTopicView(TopicActionBaseView):
     def action(self, topic):
         topic.sticky = False
-        topic.save()
+        update_fields(topic, 'sticky')
 
 
 class CloseTopicView(TopicActionBaseView):
     def action(self, topic):
         topic.closed = True
-        topic.save()
+        update_fields(topic, 'closed')
 
 
 class OpenTopicView(TopicActionBaseView):
     def action(self, topic):
         topic.closed = False
-        topic.save()
+        update_fields(topic, 'closed')
 
 
 class TopicPollVoteView(generic.UpdateView):
@@ -687,16 +804,13 @@ def add_watch_area_subscription(request, watch_area_id):
 @login_required
 def post_ajax_preview(request):
     content = request.POST.get('data')
-    html = defaults.PYBB_MARKUP_ENGINES[defaults.PYBB_MARKUP](content)
+    html = render_markup(content)
     return render(request, 'pybb/_markitup_preview.html', {'html': html})
 
 
 @login_required
 def mark_all_as_read(request):
-    for forum in filter_hidden(request, Forum):
-        forum_mark, new = ForumReadTracker.objects.get_or_create(forum=forum, user=request.user)
-        forum_mark.save()
-    TopicReadTracker.objects.filter(user=request.user).delete()
+    get_read_tracking().mark_forums_read(filter_hidden(request, Forum), [request.user])
     msg = _('All forums marked as read')
     messages.success(request, msg, fail_silently=True)
     return redirect(reverse('pybb:index'))